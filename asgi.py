@@ -0,0 +1,108 @@
+"""
+Asynchronous (ASGI) serving mode for the order routing server
+
+The flask app is served under an ASGI server through the a2wsgi
+adapter. This does not make the broker calls non-blocking: each
+request still runs on a handler thread and the broker calls of a
+route block that thread, so as many requests are served at the
+same time as with the threaded flask server.
+What this mode adds is one adapter with its own handler threads
+for each priority class, so a slow /positions never holds up
+/panic or /order, and /stream is served on the event loop so a
+subscriber does not hold a handler thread while it is connected.
+
+Run with
+    python asgi.py
+or with any ASGI server
+    uvicorn asgi:application --port 8181
+a2wsgi and uvicorn are needed (see requirements.txt)
+"""
+import asyncio
+import queue
+import sys
+
+from a2wsgi import WSGIMiddleware
+from werkzeug.exceptions import HTTPException
+
+from server import app, route_priority, PUBLISHER, JOURNAL
+from scheduler import EMERGENCY, ORDER, READ
+from settings import ASGI_WORKERS, EMERGENCY_WORKERS, ORDER_WORKERS
+from stream import HEARTBEAT, event_text
+
+LANES = {
+        EMERGENCY: WSGIMiddleware(app, workers=EMERGENCY_WORKERS),
+        ORDER: WSGIMiddleware(app, workers=ORDER_WORKERS),
+        READ: WSGIMiddleware(app, workers=ASGI_WORKERS),
+        }
+URL_ADAPTER = app.url_map.bind('localhost')
+
+
+def endpoint_of(path:str, method:str='GET'):
+    """
+    Endpoint of the route matching the path; None if no route matches
+    """
+    try:
+        endpoint, _ = URL_ADAPTER.match(path, method=method)
+        return endpoint
+    except HTTPException:
+        return None
+
+
+async def stream(scope, receive, send):
+    """
+    Serve /stream on the event loop; the subscriber is
+    woken by the publisher instead of waiting on a thread
+    """
+    loop = asyncio.get_running_loop()
+    ready = asyncio.Event()
+    closed = asyncio.Event()
+    async def wait_disconnect():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+        closed.set()
+        ready.set()
+    client = scope.get('client') or ('', 0)
+    JOURNAL.write('request', route='stream', method=scope['method'], path=scope['path'],
+            remote_addr=client[0])
+    subscriber = PUBLISHER.subscribe(notify=lambda: loop.call_soon_threadsafe(ready.set))
+    watcher = asyncio.ensure_future(wait_disconnect())
+    try:
+        await send({'type': 'http.response.start', 'status': 200,
+            'headers': [(b'content-type', b'text/event-stream; charset=utf-8'),
+                (b'cache-control', b'no-cache')]})
+        while not closed.is_set():
+            try:
+                text = event_text(*subscriber.get_nowait())
+            except queue.Empty:
+                ready.clear()
+                if not subscriber.empty():
+                    continue
+                try:
+                    await asyncio.wait_for(ready.wait(), PUBLISHER.heartbeat)
+                    continue
+                except asyncio.TimeoutError:
+                    text = HEARTBEAT
+            await send({'type': 'http.response.body', 'body': text.encode('utf8'),
+                'more_body': True})
+    finally:
+        watcher.cancel()
+        PUBLISHER.unsubscribe(subscriber)
+
+
+async def application(scope, receive, send):
+    """
+    ASGI entry point
+    """
+    if scope['type'] == 'http':
+        endpoint = endpoint_of(scope['path'], scope['method'])
+        if endpoint == 'stream':
+            return await stream(scope, receive, send)
+        return await LANES[route_priority(endpoint)](scope, receive, send)
+    return await LANES[READ](scope, receive, send)
+
+if __name__ == "__main__":
+    try:
+        import uvicorn
+    except ImportError:
+        sys.exit('uvicorn is not installed; pip install uvicorn')
+    uvicorn.run(application, port=8181)
@@ -0,0 +1,76 @@
+"""
+Microbenchmark of the per user preparation cost of an order
+
+Compares the old path (deepcopy of the arguments and quantity
+computed inside each user's call) with a compiled OrderPlan.
+The parser cache is cleared before each plan so that both
+paths parse the arguments once per order
+
+Run from the repository root
+    python benchmarks/bench_order_plan.py
+"""
+import os
+import sys
+import timeit
+from copy import deepcopy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from plan import ArgsParser, OrderPlan
+
+SHORTCUTS = {'exc': 'exchange', 'sym': 'symbol', 'qty': 'quantity',
+        'side': 'side', 'ot': 'order_type', 'prd': 'product', 'val': 'validity'}
+VARARGS = "exc=NFO/sym=NIFTY2262315500CE/qty=50/side=BUY/ot=MARKET/prd=NRML/val=DAY"
+NUM_USERS = 50
+LOT_SIZE = 50
+NUMBER = 2000
+
+
+class BenchUser(object):
+    """
+    Stand-in for a user with only the attributes used to prepare an order
+    """
+    def __init__(self, capital:float):
+        self.capital = capital
+        self.allowed_segments = ['NSE', 'NFO']
+
+    def quantity(self, qty:int=1)->int:
+        return int(self.capital*int(qty))
+
+
+def transform(varargs):
+    text = [txt.split('=') for txt in varargs.split('/')]
+    dct = {x:y for x,y in text}
+    return {SHORTCUTS.get(k) or k: v for k,v in dct.items()}
+
+
+def old_path(users):
+    order_args = transform(VARARGS)
+    exchange = order_args.get('exchange', 'NSE')
+    for user in users:
+        if exchange in user.allowed_segments:
+            kwargs = deepcopy(order_args)
+            quantity = user.quantity(kwargs.get('quantity', 0))
+            kwargs['quantity'] = round(quantity/LOT_SIZE)*LOT_SIZE
+
+
+def plan_path(parser, users):
+    parser.clear()
+    plan = OrderPlan(parser.parse(VARARGS), users, lot_size=LOT_SIZE)
+    for user in users:
+        plan.payload(user)
+
+
+def main():
+    users = [BenchUser(capital=1+i%4) for i in range(NUM_USERS)]
+    parser = ArgsParser(SHORTCUTS)
+    results = {
+            'deepcopy': timeit.timeit(lambda: old_path(users), number=NUMBER),
+            'order plan': timeit.timeit(lambda: plan_path(parser, users), number=NUMBER),
+            }
+    for name, total in results.items():
+        per_user = total/NUMBER/NUM_USERS*1e6
+        print(f"{name:12}|{NUM_USERS} users|{per_user:.2f} us per user")
+
+
+if __name__ == "__main__":
+    main()
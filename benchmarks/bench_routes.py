@@ -0,0 +1,130 @@
+"""
+Benchmark of the fan-out routes against a fake broker
+
+Every route is called with 1, 10, 50 and 200 synthetic users
+through the flask test client; no account or network is needed.
+Reports throughput, p50 and p99 latency of a request and the
+fan-out skew, the time between the first and the last call of
+a broker method started by a request
+
+Run from the repository root
+    python benchmarks/bench_routes.py [--requests 20] [--latency 0.02] [--jitter 0.005]
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)
+
+import fake_broker
+fake_broker.install()
+
+import settings
+settings.CONTRACTS_DIR = tempfile.mkdtemp(prefix='contracts_')
+settings.JOURNAL_DIR = tempfile.mkdtemp(prefix='journal_')
+
+import contracts
+contracts.ContractStore(directory=settings.CONTRACTS_DIR, exchanges=['NSE', 'NFO']).save([
+    contracts.Contract('NFO', 'NIFTY22JUNFUT', 1, 50, 0.05),
+    contracts.Contract('NFO', 'BANKNIFTY22JUNFUT', 2, 25, 0.05),
+    ])
+
+USER_COUNTS = [1, 10, 50, 200]
+
+import user
+ALL_USERS = [user.User(f"BENCH{i}", 'password', 'pin', 'secret', capital=1+i%3,
+            exc_code=3)
+        for i in range(max(USER_COUNTS))]
+# Users are added to the server one count at a time
+user.load_all_users = lambda *args, **kwargs: []
+
+import server
+
+ROUTES = [
+        ('order', '/order/exc=NFO/sym=NIFTY22JUNFUT/qty=50/side=BUY/ot=MARKET/prd=MIS'),
+        ('batch', '/batch/exc=NFO/sym=NIFTY22JUNFUT/qty=50/side=SELL;exc=NFO/sym=BANKNIFTY22JUNFUT/qty=25/side=SELL'),
+        ('bracket', '/bracket/exc=NSE/sym=TATAPOWER-EQ/qty=4/sq_val=1/sl_val=1/pr=82.8/ot=LIMIT/prd=BO/side=BUY'),
+        ('bracket_stop', '/bs/NIFTY22JUNFUT/90'),
+        ('bracket_target', '/bt/NIFTY22JUNFUT/120'),
+        ('bracket_exit', '/be/NIFTY22JUNFUT'),
+        ('mis_stop', '/ms/NIFTY22JUNFUT/90'),
+        ('nrml_target', '/nt/BANKNIFTY22JUNFUT/80'),
+        ('mis_target', '/mt/NIFTY22JUNFUT/120'),
+        ('nrml_exit', '/ne/BANKNIFTY22JUNFUT'),
+        ('mis_exit', '/me/NIFTY22JUNFUT'),
+        ('nrml_stop', '/ns/BANKNIFTY22JUNFUT/110'),
+        ('stop_and_buy', '/copy/NIFTY22JUNFUT/BANKNIFTY22JUNFUT'),
+        ('modify', '/modify/sym=NIFTY22JUNFUT/side=SELL/trgpr=95'),
+        ('cancel', '/cancel/sym=NIFTY22JUNFUT/side=SELL/status=trigger%20pending'),
+        ('pending', '/pending'),
+        ('positions', '/positions'),
+        ('mtm', '/mtm'),
+        ('mtm_by_symbol', '/mtm/symbols'),
+        ('cancel_all', '/cancel_all'),
+        ('panic', '/panic'),
+        ]
+
+
+def percentile(values, q:float)->float:
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(len(values)-1, int(round(q*(len(values)-1))))]
+
+
+def bench_route(client, path:str, num_requests:int):
+    """
+    Call the route num_requests times
+    returns the latency and the fan-out skew of each request
+    """
+    latencies, skews = [], []
+    for i in range(num_requests):
+        # Read routes go to the broker on every request
+        for u in server.USERS:
+            u.invalidate()
+        server.COALESCE.forget()
+        fake_broker.reset_calls()
+        start = time.monotonic()
+        with contextlib.redirect_stdout(io.StringIO()):
+            response = client.get(path)
+        latencies.append(time.monotonic() - start)
+        if response.status_code != 200:
+            print(f"{path} returned {response.status_code}")
+        # Spread of the calls of each broker method; routes
+        # reading positions first have two fan-outs
+        skews.append(max([max(times) - min(times) for times in fake_broker.CALLS.values()],
+            default=0))
+    return latencies, skews
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--requests', type=int, default=20, help='requests per route')
+    parser.add_argument('--latency', type=float, default=0.02, help='broker latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.005, help='broker jitter in seconds')
+    parser.add_argument('--users', type=int, nargs='*', default=USER_COUNTS)
+    args = parser.parse_args()
+    fake_broker.configure(args.latency, args.jitter)
+    server.RISK.stop()
+    client = server.app.test_client()
+    print(f"{'route':16}|{'users':>5}|{'req/s':>8}|{'p50 ms':>8}|{'p99 ms':>8}|{'skew p50 ms':>11}|{'skew p99 ms':>11}")
+    for count in args.users:
+        server.USERS[:] = ALL_USERS[:count]
+        for name, path in ROUTES:
+            start = time.monotonic()
+            latencies, skews = bench_route(client, path, args.requests)
+            throughput = args.requests/(time.monotonic() - start)
+            print(f"{name:16}|{count:5}|{throughput:8.1f}|"
+                    f"{percentile(latencies, 0.5)*1000:8.1f}|{percentile(latencies, 0.99)*1000:8.1f}|"
+                    f"{percentile(skews, 0.5)*1000:11.1f}|{percentile(skews, 0.99)*1000:11.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+In-process fake of the MasterTrust broker used by the server
+
+Every broker call sleeps for a configurable latency with jitter
+and records when it started, so that the spread of a fan-out
+across users can be measured. Call install() before importing
+the user or server modules
+"""
+import random
+import sys
+import threading
+import time
+import types
+from typing import Dict, List
+
+# Mean latency and jitter of a broker call in seconds
+LATENCY = 0.02
+JITTER = 0.005
+
+# Start time of broker calls by method name
+CALLS:Dict[str, List[float]] = {}
+_lock = threading.Lock()
+
+
+def configure(latency:float=0.02, jitter:float=0.005):
+    global LATENCY, JITTER
+    LATENCY = latency
+    JITTER = jitter
+
+
+def reset_calls():
+    with _lock:
+        CALLS.clear()
+
+
+def _call(method:str):
+    with _lock:
+        CALLS.setdefault(method, []).append(time.monotonic())
+    delay = LATENCY + random.uniform(-JITTER, JITTER)
+    if delay > 0:
+        time.sleep(delay)
+
+
+class FakeMasterTrust(object):
+    """
+    Fake broker with the methods and attributes used by the server
+    """
+    def __init__(self, client_id:str, password:str=None, PIN:str=None,
+            secret:str=None, token_file:str=None, **kwargs):
+        self._client_id:str = client_id
+        self.token_file:str = token_file
+        self.base_url:str = "http://127.0.0.1"
+        self.contracts:Dict = {}
+        self.exchange:str = 'NSE'
+        self._positions:List[Dict] = [
+                {'symbol': 'NIFTY22JUNFUT', 'exchange': 'NFO', 'product': 'MIS',
+                    'quantity': 50, 'side': 'BUY', 'ltp': 110.0, 'net_amount': -5000.0,
+                    'realized_mtm': 0.0, 'average_buy_price': 100.0, 'average_sell_price': 0.0},
+                {'symbol': 'BANKNIFTY22JUNFUT', 'exchange': 'NFO', 'product': 'NRML',
+                    'quantity': -25, 'side': 'SELL', 'ltp': 90.0, 'net_amount': 2500.0,
+                    'realized_mtm': 0.0, 'average_buy_price': 0.0, 'average_sell_price': 100.0},
+                ]
+        self._pending:List[Dict] = [
+                {'oms_order_id': '1', 'symbol': 'NIFTY22JUNFUT', 'exchange': 'NFO',
+                    'product': 'MIS', 'side': 'SELL', 'order_type': 'SL',
+                    'status': 'trigger pending', 'quantity': 50, 'price': 95.0,
+                    'trigger_price': 96.0, 'leg_order_indicator': None, 'validity': 'DAY'},
+                ]
+
+    @property
+    def client_id(self)->str:
+        return self._client_id
+
+    def authenticate(self, force:bool=False):
+        pass
+
+    @staticmethod
+    def filter(data:List[Dict], **kwargs)->List[Dict]:
+        return [d for d in data if all(d.get(k) == v for k,v in kwargs.items())]
+
+    def positions(self)->List[Dict]:
+        _call('positions')
+        return [dict(p) for p in self._positions]
+
+    def pending_orders(self)->List[Dict]:
+        _call('pending_orders')
+        return [dict(o) for o in self._pending]
+
+    def mtm(self, positions:List[Dict]=None)->float:
+        positions = positions or self.positions()
+        return sum(p['net_amount'] + p['ltp']*p['quantity'] if p['quantity']
+                else p['realized_mtm'] for p in positions)
+
+    def order_place(self, **kwargs)->Dict:
+        _call('order_place')
+        return {'oms_order_id': str(random.randint(1, 10**6))}
+
+    def order_cancel(self, oms_order_id:str)->Dict:
+        _call('order_cancel')
+        return {'oms_order_id': oms_order_id}
+
+    def modify_all_orders_by_conditions(self, modifications:Dict=None, n:int=0, **kwargs)->List:
+        _call('modify_all_orders_by_conditions')
+        return [{'oms_order_id': o['oms_order_id']} for o in self.filter(self._pending)]
+
+    def cancel_all_orders_by_conditions(self, n:int=0, **kwargs)->List:
+        _call('cancel_all_orders_by_conditions')
+        return [{'oms_order_id': o['oms_order_id']} for o in self.filter(self._pending)]
+
+    def cancel_all_orders(self, **kwargs):
+        _call('cancel_all_orders')
+
+    def place_bracket_order(self, **kwargs)->Dict:
+        _call('place_bracket_order')
+        return {'oms_order_id': str(random.randint(1, 10**6))}
+
+    def modify_bracket_stop(self, symbol:str, stop:float, *args)->List:
+        _call('modify_bracket_stop')
+        return []
+
+    def modify_bracket_target(self, symbol:str, target:float, *args)->List:
+        _call('modify_bracket_target')
+        return []
+
+    def exit_bracket_by_symbol(self, symbol:str, *args)->List:
+        _call('exit_bracket_by_symbol')
+        return []
+
+    def exit_bracket_order(self, **kwargs)->Dict:
+        _call('exit_bracket_order')
+        return kwargs
+
+
+def install():
+    """
+    Make the fake importable as fastbt.brokers.master_trust.MasterTrust
+    """
+    module = types.ModuleType('fastbt.brokers.master_trust')
+    module.MasterTrust = FakeMasterTrust
+    module.requests = None
+    sys.modules.setdefault('fastbt', types.ModuleType('fastbt'))
+    sys.modules.setdefault('fastbt.brokers', types.ModuleType('fastbt.brokers'))
+    sys.modules['fastbt.brokers.master_trust'] = module
@@ -0,0 +1,170 @@
+import threading
+import time
+from collections import defaultdict
+from typing import Callable, Dict, List, Any, Tuple
+
+
+class SnapshotCache(object):
+    """
+    Cache the result of a broker call for a short time
+    so that concurrent requests share a single round trip
+    """
+    def __init__(self, fetch:Callable, ttl:float=1.0):
+        """
+        fetch
+            function called to get a fresh snapshot
+        ttl
+            time to live of a snapshot in seconds
+        """
+        self._fetch = fetch
+        self._ttl:float = ttl
+        self._lock = threading.Lock()
+        self._data = None
+        self._timestamp:float = 0
+        self._generation:int = 0
+        # Number of the last fetch and of the last fetch
+        # passed to the listeners
+        self._fetches:int = 0
+        self._notified:int = 0
+        self._notify_lock = threading.Lock()
+        self.hits:int = 0
+        self.misses:int = 0
+        self.invalidations:int = 0
+        self._listeners:List[Callable] = []
+
+    def add_listener(self, listener:Callable):
+        """
+        Call listener(data) whenever a fresh snapshot is fetched;
+        listeners are called after the lock is released so they
+        may read the snapshot again from any thread
+        """
+        self._listeners.append(listener)
+
+    @property
+    def ttl(self)->float:
+        return self._ttl
+
+    @property
+    def is_fresh(self)->bool:
+        """
+        Check whether the snapshot can be reused
+        """
+        if self._data is None:
+            return False
+        return (time.monotonic() - self._timestamp) < self._ttl
+
+    @property
+    def is_empty(self)->bool:
+        """
+        Check whether there is no snapshot since it was
+        never fetched or was invalidated
+        """
+        return self._data is None
+
+    def get(self):
+        """
+        Get the snapshot, fetching it only if it is stale.
+        Callers waiting on the lock reuse the snapshot
+        fetched by the caller holding it
+        """
+        with self._lock:
+            if self.is_fresh:
+                self.hits += 1
+                return self._data
+            self.misses += 1
+            generation = self._generation
+            timestamp = time.monotonic()
+            data = self._fetch()
+            # Do not cache error responses or a snapshot
+            # invalidated while it was being fetched
+            if type(data) == list and generation == self._generation:
+                self._data = data
+                self._timestamp = timestamp
+            self._fetches += 1
+            fetch = self._fetches
+        if type(data) == list and self._listeners:
+            self._notify(fetch, data)
+        return data
+
+    def _notify(self, fetch:int, data:List):
+        # Skip a snapshot older than one already passed on
+        with self._notify_lock:
+            if fetch < self._notified:
+                return
+            self._notified = fetch
+        for listener in self._listeners:
+            try:
+                listener(data)
+            except Exception as e:
+                print(e)
+
+    def invalidate(self):
+        """
+        Discard the current snapshot
+        """
+        self._generation += 1
+        self._data = None
+        self.invalidations += 1
+
+    @property
+    def stats(self)->Dict[str, Any]:
+        return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'ttl': self._ttl
+                }
+
+
+class SnapshotIndex(object):
+    """
+    Records of a snapshot grouped by the values of some fields;
+    the index is rebuilt only when a different snapshot is looked up
+    """
+    def __init__(self, fields:Tuple[str, ...]):
+        """
+        fields
+            fields making up the key of a group
+        """
+        self._fields:Tuple[str, ...] = tuple(fields)
+        self._state = (None, {})
+        self.rebuilds:int = 0
+
+    @property
+    def fields(self)->Tuple[str, ...]:
+        return self._fields
+
+    def _groups(self, data:List[Dict])->Dict[Tuple, List[Dict]]:
+        snapshot, groups = self._state
+        if snapshot is not data:
+            groups = defaultdict(list)
+            if type(data) == list:
+                for record in data:
+                    groups[tuple(record.get(f) for f in self._fields)].append(record)
+            groups = dict(groups)
+            # Replaced at once so that readers see a consistent index
+            self._state = (data, groups)
+            self.rebuilds += 1
+        return groups
+
+    def get(self, data:List[Dict], *key)->List[Dict]:
+        """
+        Records of the snapshot with the given values of the fields
+        """
+        return self._groups(data).get(key, [])
+
+    def covers(self, conditions:Dict)->bool:
+        return all(f in conditions for f in self._fields)
+
+    def select(self, data:List[Dict], conditions:Dict)->List[Dict]:
+        """
+        Records of the snapshot matching all the conditions
+        like broker.filter; only the group of the key is
+        scanned if the conditions include all the fields
+        """
+        if self.covers(conditions):
+            records = self.get(data, *(conditions[f] for f in self._fields))
+            conditions = {k:v for k,v in conditions.items() if k not in self._fields}
+        else:
+            records = data if type(data) == list else []
+        return [r for r in records if all(r.get(k) == v for k,v in conditions.items())]
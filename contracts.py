@@ -0,0 +1,144 @@
+"""
+Contract master with a dated on-disk snapshot
+
+Contracts are downloaded once a day and saved as a pickle
+of plain tuples so that a restart on the same day loads
+them without downloading or parsing json again.
+A single store is shared by all users
+"""
+import datetime
+import glob
+import os
+import pickle
+from collections import namedtuple
+from typing import Dict, List, Optional
+
+import requests
+
+CONTRACTS_URL = "https://masterswift.mastertrust.co.in/api/v2/contracts.json?exchanges={exc}"
+
+Contract = namedtuple('Contract', ['exchange', 'symbol', 'token', 'lot_size', 'tick_size'])
+
+
+def parse_contracts(exchange:str, data:Dict)->List[Contract]:
+    """
+    Parse the json response of the contract master
+    exchange
+        exchange of the contracts
+    data
+        json response as a dictionary
+    """
+    contracts = []
+    for rows in data.values():
+        for c in rows:
+            # Contracts without a lot size use the default of the exchange
+            lot_size = c.get('lot_size') or c.get('lotSize')
+            tick_size = c.get('tick_size') or c.get('tickSize') or 0.05
+            contracts.append(Contract(exchange, c['trading_symbol'], c['code'],
+                int(lot_size) if lot_size else None, float(tick_size)))
+    return contracts
+
+
+class ContractStore(object):
+    """
+    Index of contracts by exchange and symbol
+    """
+    def __init__(self, directory:str='contracts', exchanges:List[str]=['NSE', 'NFO'],
+            default_lot_size:Dict[str,int]=None):
+        """
+        directory
+            directory to save the daily snapshot
+        exchanges
+            exchanges to load
+        default_lot_size
+            lot size by exchange for symbols not in the store
+        """
+        self._directory:str = directory
+        self._exchanges:List[str] = exchanges
+        self._default_lot_size:Dict[str,int] = default_lot_size or {}
+        self._contracts:Dict[str, Contract] = {}
+        self._tokens:Dict[str, int] = {}
+
+    @property
+    def tokens(self)->Dict[str, int]:
+        """
+        Instrument tokens keyed by EXCHANGE:SYMBOL as expected by the broker
+        """
+        return self._tokens
+
+    def __len__(self)->int:
+        return len(self._contracts)
+
+    def snapshot_file(self, date:datetime.date=None)->str:
+        date = date or datetime.date.today()
+        exchanges = '_'.join(self._exchanges)
+        return os.path.join(self._directory, f"contracts_{exchanges}_{date:%Y%m%d}.pkl")
+
+    def download(self)->List[Contract]:
+        contracts = []
+        for exchange in self._exchanges:
+            data = requests.get(CONTRACTS_URL.format(exc=exchange)).json()
+            contracts.extend(parse_contracts(exchange, data))
+        return contracts
+
+    def save(self, contracts:List[Contract]):
+        """
+        Save the snapshot for the day and remove older snapshots
+        """
+        os.makedirs(self._directory, exist_ok=True)
+        filename = self.snapshot_file()
+        for old in glob.glob(os.path.join(self._directory, 'contracts_*.pkl')):
+            if old != filename:
+                os.remove(old)
+        with open(filename, 'wb') as f:
+            pickle.dump([tuple(c) for c in contracts], f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def load(self):
+        """
+        Load the snapshot of the day if it exists
+        else download the contracts and save a snapshot
+        """
+        filename = self.snapshot_file()
+        if os.path.exists(filename):
+            with open(filename, 'rb') as f:
+                contracts = [Contract(*c) for c in pickle.load(f)]
+        else:
+            contracts = self.download()
+            self.save(contracts)
+        self.index(contracts)
+        return self
+
+    def index(self, contracts:List[Contract]):
+        self._contracts = {f"{c.exchange}:{c.symbol}": c for c in contracts}
+        self._tokens = {key: c.token for key,c in self._contracts.items()}
+
+    def get(self, symbol:str, exchange:str='NFO')->Optional[Contract]:
+        return self._contracts.get(f"{exchange}:{symbol}")
+
+    def lot_size(self, symbol:str, exchange:str='NFO')->int:
+        """
+        Lot size of the symbol; the default lot size of the
+        exchange for symbols not in the store or without one
+        """
+        contract = self.get(symbol, exchange)
+        if contract and contract.lot_size:
+            return contract.lot_size
+        return self._default_lot_size.get(exchange, 1)
+
+    def tick_size(self, symbol:str, exchange:str='NFO')->float:
+        contract = self.get(symbol, exchange)
+        return contract.tick_size if contract else 0.05
+
+    def round_quantity(self, quantity:int, symbol:str, exchange:str='NFO')->int:
+        """
+        Round down the quantity to the lot size of the symbol
+        """
+        lot_size = self.lot_size(symbol, exchange)
+        return int(quantity/lot_size)*lot_size
+
+    def round_price(self, price:float, symbol:str, exchange:str='NFO')->float:
+        """
+        Round the price to the tick size of the symbol
+        """
+        tick_size = self.tick_size(symbol, exchange)
+        return round(round(price/tick_size)*tick_size, 2)
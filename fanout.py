@@ -0,0 +1,92 @@
+import concurrent.futures
+import time
+from collections import namedtuple
+from typing import Callable, Dict, Iterable, List
+from scheduler import PriorityExecutor, READ
+
+# wait is the time spent in the queue; started and finished
+# are the monotonic times at which the call started and ended
+Result = namedtuple('Result', ['item', 'value', 'error', 'elapsed', 'wait', 'started', 'finished'],
+        defaults=(None, None, None))
+
+
+class FanOut(object):
+    """
+    A long lived thread pool to call a function
+    for a list of items (usually users) concurrently
+    """
+    def __init__(self, max_workers:int=32, timeout:float=10, reserved:Dict[int,int]=None):
+        """
+        max_workers
+            number of threads in the pool shared by all priorities
+        timeout
+            default time in seconds to wait for each item
+        reserved
+            number of additional threads reserved for a priority
+        """
+        self._timeout:float = timeout
+        self._executor = PriorityExecutor(shared=max_workers, reserved=reserved)
+
+    @property
+    def max_workers(self)->int:
+        return self._executor.max_workers
+
+    @property
+    def stats(self)->Dict[str, Dict]:
+        return self._executor.stats
+
+    @property
+    def timeout(self)->float:
+        return self._timeout
+
+    @staticmethod
+    def _timed(func:Callable, item, *args, **kwargs):
+        start = time.monotonic()
+        value = func(item, *args, **kwargs)
+        return value, start, time.monotonic()
+
+    def map(self, func:Callable, items:Iterable, *args, timeout:float=None, priority:int=READ, **kwargs)->List[Result]:
+        """
+        Call func(item, *args, **kwargs) for each item concurrently
+        func
+            function to call with the item as the first argument
+        items
+            list of items
+        timeout
+            time in seconds to wait for all the items;
+            items not done by then are returned with a TimeoutError
+        priority
+            priority class of the calls
+        returns a list of results in the same order as items
+        """
+        timeout = self._timeout if timeout is None else timeout
+        items = list(items)
+        submitted = []
+        futures = []
+        for item in items:
+            submitted.append(time.monotonic())
+            futures.append(self._executor.submit(priority, self._timed, func, item, *args, **kwargs))
+        deadline = time.monotonic() + timeout
+        results = []
+        for item, future, queued in zip(items, futures, submitted):
+            try:
+                value, started, finished = future.result(timeout=max(0, deadline - time.monotonic()))
+                results.append(Result(item, value, None, finished-started,
+                    started-queued, started, finished))
+            except concurrent.futures.TimeoutError:
+                # Drop the call if it has not started yet
+                future.cancel()
+                results.append(Result(item, None, TimeoutError(f'timed out after {timeout}s'), timeout))
+            except Exception as e:
+                results.append(Result(item, None, e, None))
+        return results
+
+    def submit(self, func:Callable, item, *args, priority:int=READ, **kwargs)->concurrent.futures.Future:
+        """
+        Call func(item, *args, **kwargs) without waiting for it
+        returns a future with the value
+        """
+        return self._executor.submit(priority, func, item, *args, **kwargs)
+
+    def shutdown(self):
+        self._executor.shutdown()
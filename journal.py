@@ -0,0 +1,234 @@
+"""
+Append-only journal of route calls and broker requests
+
+Records are queued by the caller and written as json lines
+by a background writer which flushes and fsyncs in batches,
+so that writing the journal never delays an order.
+One file is written per day
+"""
+import datetime
+import json
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from collections.abc import Mapping
+from typing import Any, Dict, Iterator, List, Optional
+from records import json_default
+
+
+def journal_file(directory:str, date:datetime.date=None)->str:
+    date = date or datetime.date.today()
+    return os.path.join(directory, f"journal_{date:%Y%m%d}.jsonl")
+
+
+def order_ids(kwargs:Dict, response:Any)->List[str]:
+    """
+    Order ids sent in a broker request or returned in its response
+    kwargs
+        keyword arguments of the request
+    response
+        response or list of responses of the broker
+    """
+    ids = []
+    def _add(data):
+        if not isinstance(data, Mapping):
+            return
+        order_id = data.get('oms_order_id')
+        if order_id is None and isinstance(data.get('data'), Mapping):
+            order_id = data['data'].get('oms_order_id')
+        if order_id is not None and order_id not in ids:
+            ids.append(order_id)
+    _add(kwargs)
+    for item in (response if isinstance(response, list) else [response]):
+        _add(item)
+    return ids
+
+
+class Journal(object):
+    """
+    Buffered journal with a background writer
+    """
+    def __init__(self, directory:str='journal', flush_interval:float=0.2):
+        """
+        directory
+            directory of the daily journal files
+        flush_interval
+            seconds between two batched writes
+        """
+        self._directory:str = directory
+        self._flush_interval:float = flush_interval
+        self._queue:deque = deque()
+        self._stop = threading.Event()
+        self._thread = None
+        self._file = None
+        self._filename:str = None
+        self.written:int = 0
+        self.batches:int = 0
+
+    def write(self, kind:str, **fields):
+        """
+        Queue a record; the timestamp is added here
+        kind
+            kind of record such as request or broker
+        """
+        fields['ts'] = time.time()
+        fields['kind'] = kind
+        self._queue.append(fields)
+
+    def _open(self):
+        filename = journal_file(self._directory)
+        if filename != self._filename:
+            if self._file:
+                self._file.close()
+            os.makedirs(self._directory, exist_ok=True)
+            self._file = open(filename, 'a', encoding='utf-8')
+            self._filename = filename
+        return self._file
+
+    def flush(self):
+        """
+        Write all queued records and fsync the file
+        """
+        if not self._queue:
+            return
+        lines = []
+        while self._queue:
+            record = self._queue.popleft()
+            lines.append(json.dumps(record, default=json_default))
+        f = self._open()
+        f.write('\n'.join(lines) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+        self.written += len(lines)
+        self.batches += 1
+
+    def _run(self):
+        while not self._stop.wait(self._flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print(e)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='journal', daemon=True)
+            self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        self.flush()
+        if self._file:
+            self._file.close()
+            self._file = None
+            self._filename = None
+
+    @property
+    def stats(self)->Dict[str, Any]:
+        return {
+                'file': self._filename,
+                'queued': len(self._queue),
+                'written': self.written,
+                'batches': self.batches
+                }
+
+
+class JournalReader(object):
+    """
+    Read a journal file once and index the
+    records by client_id, symbol and order id
+    """
+    def __init__(self, filename:str):
+        """
+        filename
+            journal file to read
+        """
+        self._records:List[Dict] = []
+        self._by_client:Dict[str, List[int]] = defaultdict(list)
+        self._by_symbol:Dict[str, List[int]] = defaultdict(list)
+        self._by_order:Dict[str, List[int]] = defaultdict(list)
+        with open(filename, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A partly written last line
+                    continue
+                i = len(self._records)
+                self._records.append(record)
+                if record.get('client_id'):
+                    self._by_client[record['client_id']].append(i)
+                if record.get('symbol'):
+                    self._by_symbol[record['symbol']].append(i)
+                for order_id in record.get('order_ids') or []:
+                    self._by_order[str(order_id)].append(i)
+
+    @classmethod
+    def for_date(cls, directory:str='journal', date:datetime.date=None):
+        return cls(journal_file(directory, date))
+
+    def __len__(self)->int:
+        return len(self._records)
+
+    @property
+    def client_ids(self)->List[str]:
+        return list(self._by_client.keys())
+
+    @property
+    def symbols(self)->List[str]:
+        return list(self._by_symbol.keys())
+
+    def records(self, client_id:str=None, symbol:str=None, kind:str=None,
+            start:float=None, end:float=None, order_id:str=None)->Iterator[Dict]:
+        """
+        Records matching all the given filters in the order written
+        client_id
+            client_id of the user
+        symbol
+            symbol of the order
+        order_id
+            broker order id sent or returned
+        kind
+            kind of record
+        start, end
+            unix timestamps between which the record was written
+        """
+        indexes:Optional[List[int]] = None
+        if client_id is not None:
+            indexes = self._by_client.get(client_id, [])
+        for index, value in ((self._by_symbol, symbol), (self._by_order, order_id)):
+            if value is None:
+                continue
+            selected = index.get(str(value) if index is self._by_order else value, [])
+            if indexes is None:
+                indexes = selected
+            else:
+                matched = set(selected)
+                indexes = [i for i in indexes if i in matched]
+        if indexes is None:
+            indexes = range(len(self._records))
+        for i in indexes:
+            record = self._records[i]
+            if kind is not None and record.get('kind') != kind:
+                continue
+            if start is not None and record['ts'] < start:
+                continue
+            if end is not None and record['ts'] > end:
+                continue
+            yield record
+
+    def replay(self, func, speed:float=None, **filters):
+        """
+        Call func(record) for each matching record
+        speed
+            replay at this multiple of the original pace;
+            as fast as possible if None
+        filters
+            filters as in records
+        """
+        previous = None
+        for record in self.records(**filters):
+            if speed and previous is not None:
+                time.sleep(max(0, (record['ts'] - previous)/speed))
+            previous = record['ts']
+            func(record)
@@ -0,0 +1,139 @@
+"""
+Latency histograms in the prometheus text format
+
+Histograms are only updated when a request is served;
+nothing runs in the background
+"""
+import bisect
+import contextlib
+import threading
+import time
+from typing import Callable, Dict, List, Tuple
+
+# Upper bounds of the buckets in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value)->str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Histogram(object):
+    """
+    A histogram with a series for each set of label values
+    """
+    def __init__(self, name:str, help:str, labels:List[str], buckets:Tuple=BUCKETS):
+        """
+        name
+            metric name
+        help
+            description of the metric
+        labels
+            label names
+        buckets
+            upper bounds of the buckets in ascending order
+        """
+        self.name:str = name
+        self.help:str = help
+        self.labels:List[str] = labels
+        self.buckets:Tuple = tuple(buckets)
+        self._lock = threading.Lock()
+        # counts of each bucket (the last one for +Inf), sum
+        self._series:Dict[Tuple, List] = {}
+
+    def observe(self, value:float, *label_values):
+        """
+        Record a value in seconds for the label values
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0]*(len(self.buckets)+1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    @contextlib.contextmanager
+    def time(self, *label_values):
+        """
+        Record the time taken by the block
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, *label_values)
+
+    def render(self)->List[str]:
+        """
+        Lines of the histogram in the prometheus text format
+        """
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = [(k, list(counts), total) for k,(counts,total) in self._series.items()]
+        for label_values, counts, total in sorted(series, key=lambda x: x[0]):
+            labels = ','.join(f'{k}="{_escape(v)}"' for k,v in zip(self.labels, label_values))
+            prefix = labels + ',' if labels else ''
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            suffix = f"{{{labels}}}" if labels else ''
+            lines.append(f"{self.name}_sum{suffix} {total}")
+            lines.append(f"{self.name}_count{suffix} {cumulative}")
+        return lines
+
+
+class Registry(object):
+    """
+    Collection of histograms rendered together
+    """
+    def __init__(self):
+        self._histograms:List[Histogram] = []
+
+    def histogram(self, name:str, help:str, labels:List[str], buckets:Tuple=BUCKETS)->Histogram:
+        histogram = Histogram(name, help, labels, buckets)
+        self._histograms.append(histogram)
+        return histogram
+
+    def render(self)->str:
+        lines = []
+        for histogram in self._histograms:
+            lines.extend(histogram.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+PARSE = REGISTRY.histogram('parse_seconds',
+        'Time to parse the arguments of a request', ['route'])
+QUEUE_WAIT = REGISTRY.histogram('queue_wait_seconds',
+        'Time a broker call waited for a worker', ['route', 'client_id'])
+BROKER = REGISTRY.histogram('broker_seconds',
+        'Round trip time of a broker call', ['route', 'client_id'])
+FANOUT_SPAN = REGISTRY.histogram('fanout_span_seconds',
+        'Time from the first call sent to the last call done in a fan-out', ['route'])
+
+
+def record_fanout(route:str, results:List, client_id:Callable):
+    """
+    Record the queue wait and round trip of each call
+    and the span of a fan-out
+    route
+        route label
+    results
+        results of FanOut.map
+    client_id
+        function returning the client_id of an item
+    """
+    started, finished = [], []
+    for result in results:
+        if result.started is None:
+            continue
+        user = client_id(result.item)
+        QUEUE_WAIT.observe(result.wait, route, user)
+        BROKER.observe(result.elapsed, route, user)
+        started.append(result.started)
+        finished.append(result.finished)
+    if started:
+        FANOUT_SPAN.observe(max(finished) - min(started), route)
@@ -0,0 +1,133 @@
+"""
+Order book of pending orders aggregated across users
+
+Orders are grouped by symbol, side and order type with the
+total quantity and average prices across users. The book is
+updated incrementally; only the groups of the user whose
+pending orders changed are recomputed
+"""
+import threading
+from collections import defaultdict
+from typing import Any, Dict, List, Tuple
+
+Key = Tuple[str, str, str]
+
+
+def to_float(value)->float:
+    """
+    Field of a broker response as a float; 0 if missing
+    """
+    try:
+        return float(value or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def group_orders(orders:List[Dict])->Dict[Key, List[Dict]]:
+    """
+    Group orders by symbol, side and order type
+    """
+    groups = defaultdict(list)
+    for o in orders:
+        groups[(o.get('symbol'), o.get('side'), o.get('order_type'))].append(o)
+    return dict(groups)
+
+
+def level_totals(orders:List[Dict])->List[float]:
+    """
+    Number of orders, quantity, value at price
+    and value at trigger price of the orders
+    """
+    quantity, value, trigger_value = 0.0, 0.0, 0.0
+    for o in orders:
+        q = to_float(o.get('quantity'))
+        quantity += q
+        value += q*to_float(o.get('price'))
+        trigger_value += q*to_float(o.get('trigger_price'))
+    return [len(orders), quantity, value, trigger_value]
+
+
+class OrderBook(object):
+    """
+    Pending orders of all users by symbol, side and order type
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._orders:Dict[str, Dict[Key, List[Dict]]] = {}
+        self._totals:Dict[str, Dict[Key, List[float]]] = {}
+        # totals and users of each level across users
+        self._levels:Dict[Key, List[float]] = {}
+        self._users:Dict[Key, set] = defaultdict(set)
+        self.version:int = 0
+
+    def update(self, client_id:str, orders:List[Dict]):
+        """
+        Replace the pending orders of a user
+        """
+        groups = group_orders(orders)
+        totals = {key: level_totals(values) for key,values in groups.items()}
+        with self._lock:
+            old = self._totals.get(client_id, {})
+            if old == totals:
+                self._orders[client_id] = groups
+                return
+            for key, values in old.items():
+                level = self._levels[key]
+                for i, v in enumerate(values):
+                    level[i] -= v
+                self._users[key].discard(client_id)
+                if not self._users[key]:
+                    del self._levels[key]
+                    del self._users[key]
+            for key, values in totals.items():
+                level = self._levels.setdefault(key, [0.0]*len(values))
+                for i, v in enumerate(values):
+                    level[i] += v
+                self._users[key].add(client_id)
+            self._orders[client_id] = groups
+            self._totals[client_id] = totals
+            self.version += 1
+
+    @staticmethod
+    def _match(key:Key, symbol:str=None, side:str=None, order_type:str=None)->bool:
+        return ((symbol is None or key[0] == symbol) and
+                (side is None or key[1] == side) and
+                (order_type is None or key[2] == order_type))
+
+    def levels(self, symbol:str=None, side:str=None, order_type:str=None)->List[Dict[str, Any]]:
+        """
+        Totals and average prices of each symbol, side and order type
+        matching the filters; all levels if no filter is given
+        """
+        rows = []
+        with self._lock:
+            for key, (count, quantity, value, trigger_value) in self._levels.items():
+                if not self._match(key, symbol, side, order_type):
+                    continue
+                rows.append({
+                    'symbol': key[0],
+                    'side': key[1],
+                    'order_type': key[2],
+                    'orders': int(count),
+                    'users': len(self._users[key]),
+                    'quantity': quantity,
+                    'avg_price': value/quantity if quantity else None,
+                    'avg_trigger_price': trigger_value/quantity if quantity else None
+                    })
+        return sorted(rows, key=lambda r: (str(r['symbol']), str(r['side']), str(r['order_type'])))
+
+    def orders(self, symbol:str=None, side:str=None, order_type:str=None,
+            client_id:str=None)->Dict[str, List[Dict]]:
+        """
+        Orders of each user matching the filters keyed by client_id
+        """
+        result = {}
+        with self._lock:
+            for cid, groups in self._orders.items():
+                if client_id is not None and cid != client_id:
+                    continue
+                matched = [o for key, values in groups.items()
+                        if self._match(key, symbol, side, order_type) for o in values]
+                if matched:
+                    result[cid] = matched
+        return result
@@ -0,0 +1,101 @@
+"""
+Compiled order plans
+
+Order arguments in the url are parsed once and the payload
+of each user, with quantity scaled by capital and rounded to
+the lot size, is computed before any order is sent
+"""
+from types import MappingProxyType
+from typing import Dict, List, Mapping, Optional
+
+
+class ArgsParser(object):
+    """
+    Parse order arguments from an url path and
+    cache the parsed arguments
+    """
+    def __init__(self, shortcuts:Dict[str,str], maxsize:int=1024):
+        """
+        shortcuts
+            shortcuts mapped to the full argument names
+        maxsize
+            maximum number of parsed urls to keep
+        """
+        self._shortcuts = shortcuts
+        self._maxsize:int = maxsize
+        self._cache:Dict[str, Mapping] = {}
+
+    def parse(self, varargs:str)->Mapping:
+        """
+        Transform the given arguments into a read only
+        dictionary of arguments for placing an order
+        varargs
+            varargs as a string like sym=NIFTY/qty=50
+        """
+        args = self._cache.get(varargs)
+        if args is None:
+            text = [txt.split('=') for txt in varargs.split('/')]
+            dct = {}
+            for k,v in text:
+                dct[self._shortcuts.get(k) or k] = v
+            args = MappingProxyType(dct)
+            if len(self._cache) >= self._maxsize:
+                self._cache.clear()
+            self._cache[varargs] = args
+        return args
+
+    def clear(self):
+        """
+        Discard the parsed arguments
+        """
+        self._cache.clear()
+
+    def parse_dict(self, dct:Dict)->Mapping:
+        """
+        Read only dictionary of arguments with
+        shortcuts replaced by the full argument names
+        dct
+            arguments as a dictionary like {'sym': 'NIFTY', 'qty': 50}
+        """
+        return MappingProxyType({self._shortcuts.get(k) or k: v for k,v in dct.items()})
+
+
+class OrderPlan(object):
+    """
+    Read only order payloads for a list of users
+    """
+    def __init__(self, args:Mapping, users:List, lot_size:int=1, check_segments:bool=True):
+        """
+        args
+            order arguments
+        users
+            users to place the order for
+        lot_size
+            quantity of each user is rounded to this lot size
+        check_segments
+            skip users not allowed to trade on the exchange
+        """
+        self._args = args
+        self._exchange:str = args.get('exchange', 'NSE')
+        self._payloads = {}
+        quantity = args.get('quantity', 0)
+        for user in users:
+            if not(check_segments) or self._exchange in user.allowed_segments:
+                qty = user.quantity(quantity)
+                qty = round(qty/lot_size)*lot_size
+                self._payloads[user] = MappingProxyType({**args, 'quantity': qty})
+
+    @property
+    def args(self)->Mapping:
+        return self._args
+
+    @property
+    def exchange(self)->str:
+        return self._exchange
+
+    def payload(self, user)->Optional[Mapping]:
+        """
+        Payload for the user;
+        None if the exchange is not allowed for the user
+        """
+        return self._payloads.get(user)
@@ -0,0 +1,146 @@
+"""
+Portfolio level MTM across all users
+
+Positions of all users are collected into a single table
+and MTM, max MTM and drawdown are computed in one pass
+"""
+import numpy as np
+import pandas as pd
+from typing import Dict, List, Any
+
+# Columns of the positions used for MTM
+NUMERIC_COLUMNS = ['quantity', 'ltp', 'net_amount', 'realized_mtm']
+
+
+def positions_frame(snapshots:Dict[str, List[Dict]])->pd.DataFrame:
+    """
+    Convert the positions of all users into a single table
+    with only the columns needed for MTM
+    snapshots
+        positions of each user keyed by client_id
+    """
+    columns = {col: [] for col in NUMERIC_COLUMNS + ['symbol', 'exchange', 'client_id']}
+    for client_id, positions in snapshots.items():
+        for p in positions:
+            for col in NUMERIC_COLUMNS:
+                columns[col].append(p.get(col, 0))
+            columns['symbol'].append(p.get('symbol', 0))
+            columns['exchange'].append(p.get('exchange') or 'NFO')
+            columns['client_id'].append(client_id)
+    frame = pd.DataFrame(columns)
+    for col in NUMERIC_COLUMNS:
+        frame[col] = pd.to_numeric(frame[col], errors='coerce').fillna(0)
+    return frame
+
+
+def compute_mtm(frame:pd.DataFrame)->np.ndarray:
+    """
+    MTM of each position
+    Same as the mtm of the broker; open positions are valued
+    at the last price and closed positions at the realized mtm
+    """
+    quantity = frame['quantity'].values
+    open_mtm = frame['net_amount'].values + frame['ltp'].values * quantity
+    return np.where(quantity != 0, open_mtm, frame['realized_mtm'].values)
+
+
+def fetch_positions(fanout, users:List, priority:int)->Dict[str, List[Dict]]:
+    """
+    Fetch the positions of all users concurrently
+    fanout
+        fan out pool
+    users
+        list of users
+    priority
+        priority class of the broker calls
+    returns positions keyed by client_id for the users
+    for whom positions could be fetched
+    """
+    snapshots = {}
+    for result in fanout.map(lambda user: user.positions(), users, priority=priority):
+        client_id = result.item.broker.client_id
+        if result.error:
+            print(client_id, result.error)
+        elif type(result.value) == list:
+            snapshots[client_id] = result.value
+    return snapshots
+
+
+class Portfolio(object):
+    """
+    MTM and drawdown of all users
+    """
+    def __init__(self, ticks=None):
+        """
+        ticks
+            tick cache with the last price of each symbol;
+            the ltp of the positions is used if not given
+        """
+        self._ticks = ticks
+        self.positions:pd.DataFrame = pd.DataFrame()
+        self.by_user:pd.DataFrame = pd.DataFrame(
+                columns=['client_id', 'mtm', 'max_mtm', 'drawdown'])
+        self.by_symbol:pd.DataFrame = pd.DataFrame(
+                columns=['symbol', 'quantity', 'mtm'])
+        self.total:float = 0
+        self._listeners:List = []
+
+    def add_listener(self, listener):
+        """
+        Call listener(portfolio) after every update
+        """
+        self._listeners.append(listener)
+
+    def update(self, users:List, snapshots:Dict[str, List[Dict]]):
+        """
+        Update the portfolio and the mtm of each user
+        users
+            list of users
+        snapshots
+            positions keyed by client_id; users not in
+            snapshots are left unchanged
+        """
+        users = [user for user in users if user.broker.client_id in snapshots]
+        client_ids = [user.broker.client_id for user in users]
+        frame = positions_frame(snapshots)
+        if self._ticks is not None and len(frame):
+            frame['ltp'] = self._live_prices(frame)
+        frame['mtm'] = compute_mtm(frame)
+        mtm = frame.groupby('client_id')['mtm'].sum().reindex(
+                client_ids, fill_value=0).values
+        for user, value in zip(users, mtm):
+            user.update_mtm(float(value))
+        max_mtm = np.array([user.max_mtm for user in users], dtype=float)
+        self.positions = frame
+        self.by_user = pd.DataFrame({
+            'client_id': client_ids,
+            'mtm': mtm,
+            'max_mtm': max_mtm,
+            'drawdown': (max_mtm-mtm)/(max_mtm+1)
+            })
+        self.by_symbol = frame.groupby('symbol').agg({
+            'quantity': 'sum',
+            'mtm': 'sum'
+            }).reset_index()
+        self.total = float(mtm.sum())
+        for listener in self._listeners:
+            try:
+                listener(self)
+            except Exception as e:
+                print(e)
+
+    def _live_prices(self, frame:pd.DataFrame)->np.ndarray:
+        """
+        Last price of each position from the tick cache
+        falling back to the ltp of the position
+        """
+        pairs = list(zip(frame['symbol'], frame['exchange']))
+        prices = {pair: self._ticks.ltp(*pair) for pair in set(pairs)}
+        live = np.array([prices[pair] for pair in pairs], dtype=float)
+        return np.where(np.isnan(live), frame['ltp'].values, live)
+
+    def user_records(self)->List[Dict[str, Any]]:
+        return self.by_user.to_dict(orient='records')
+
+    def symbol_records(self)->List[Dict[str, Any]]:
+        return self.by_symbol.to_dict(orient='records')
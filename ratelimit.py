@@ -0,0 +1,166 @@
+"""
+Rate limits of broker calls
+
+Every http request to the broker takes a token from the bucket of
+its account and from a global bucket, so a broker call sending many
+requests takes many tokens. Calls without a token wait in a queue
+instead of being rejected by the broker; waiting calls are served
+by priority so that exits and cancels go before reads
+"""
+import itertools
+import threading
+import time
+from typing import Any, Dict, List, Tuple
+
+from scheduler import PRIORITY_NAMES, READ
+
+
+class TokenBucket(object):
+    """
+    Tokens added at a fixed rate upto a capacity;
+    not thread safe, used under the lock of the limiter
+    """
+    def __init__(self, rate:float, capacity:float):
+        """
+        rate
+            tokens added per second
+        capacity
+            maximum number of tokens; the burst allowed
+        """
+        self.rate:float = rate
+        self.capacity:float = capacity
+        self.tokens:float = capacity
+        self._last:float = time.monotonic()
+
+    def refill(self, now:float):
+        self.tokens = min(self.capacity, self.tokens + (now - self._last)*self.rate)
+        self._last = now
+
+    def wait_time(self)->float:
+        """
+        Seconds until a token is available
+        """
+        return max(0, (1 - self.tokens)/self.rate)
+
+
+class RateLimiter(object):
+    """
+    Per account and global token buckets with a priority queue
+    """
+    def __init__(self, rate:float=10, burst:float=10, global_rate:float=None,
+            global_burst:float=None):
+        """
+        rate, burst
+            calls per second and burst of each account
+        global_rate, global_burst
+            calls per second and burst of all accounts together;
+            no global limit if global_rate is None
+        """
+        self._rate:float = rate
+        self._burst:float = burst
+        self._global = TokenBucket(global_rate, global_burst or global_rate) if global_rate else None
+        self._buckets:Dict[str, TokenBucket] = {}
+        self._condition = threading.Condition()
+        self._waiting:List[Tuple[int, int, str]] = []
+        self._seq = itertools.count()
+        self.calls:int = 0
+        self.throttled:int = 0
+        self.total_wait:float = 0
+        self.max_wait:float = 0
+
+    def _bucket(self, account:str)->TokenBucket:
+        bucket = self._buckets.get(account)
+        if bucket is None:
+            bucket = self._buckets[account] = TokenBucket(self._rate, self._burst)
+        return bucket
+
+    def _can_go(self, entry:Tuple[int, int, str], now:float)->bool:
+        """
+        A call goes if its account and the global bucket have a token,
+        no earlier or more urgent call of the account is waiting and no
+        more urgent call of an account with a token is waiting
+        """
+        if self._global is not None:
+            self._global.refill(now)
+            if self._global.tokens < 1:
+                return False
+        bucket = self._bucket(entry[2])
+        bucket.refill(now)
+        if bucket.tokens < 1:
+            return False
+        for other in self._waiting:
+            if other >= entry:
+                continue
+            if other[2] == entry[2]:
+                return False
+            if self._global is not None:
+                other_bucket = self._bucket(other[2])
+                other_bucket.refill(now)
+                if other_bucket.tokens >= 1:
+                    return False
+        return True
+
+    def _wait_time(self, account:str)->float:
+        wait = self._bucket(account).wait_time()
+        if self._global is not None:
+            wait = max(wait, self._global.wait_time())
+        return min(max(wait, 0.001), 0.1)
+
+    def acquire(self, account:str, priority:int=READ)->float:
+        """
+        Wait for a token of the account
+        account
+            client_id of the user
+        priority
+            priority class of the call
+        returns the seconds waited
+        """
+        start = time.monotonic()
+        entry = (priority, next(self._seq), account)
+        with self._condition:
+            self._waiting.append(entry)
+            try:
+                while not self._can_go(entry, time.monotonic()):
+                    self._condition.wait(self._wait_time(account))
+                self._bucket(account).tokens -= 1
+                if self._global is not None:
+                    self._global.tokens -= 1
+            finally:
+                self._waiting.remove(entry)
+                self._condition.notify_all()
+            wait = time.monotonic() - start
+            self.calls += 1
+            if wait > 0.001:
+                self.throttled += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+        return wait
+
+    @property
+    def stats(self)->Dict[str, Any]:
+        with self._condition:
+            now = time.monotonic()
+            for bucket in self._buckets.values():
+                bucket.refill(now)
+            waiting = {name: 0 for name in PRIORITY_NAMES.values()}
+            for priority, _, _ in self._waiting:
+                waiting[PRIORITY_NAMES[priority]] += 1
+            stats = {
+                    'rate': self._rate,
+                    'burst': self._burst,
+                    'calls': self.calls,
+                    'throttled': self.throttled,
+                    'avg_wait_ms': round(self.total_wait/self.calls*1000, 3) if self.calls else 0,
+                    'max_wait_ms': round(self.max_wait*1000, 3),
+                    'waiting': waiting,
+                    'tokens': {account: round(bucket.tokens, 2)
+                        for account, bucket in self._buckets.items()}
+                    }
+            if self._global is not None:
+                self._global.refill(now)
+                stats['global'] = {
+                        'rate': self._global.rate,
+                        'burst': self._global.capacity,
+                        'tokens': round(self._global.tokens, 2)
+                        }
+            return stats
@@ -0,0 +1,118 @@
+"""
+Compact records of positions and orders
+
+Broker responses are converted into records once per fetch
+and the same records are shared by the routes, the risk
+engine, the indexes and the reports. Known fields are kept
+in slots; any other field sent by the broker is kept in a
+dictionary so that nothing is lost
+"""
+from collections.abc import Mapping
+from typing import Any, Dict, Iterator, Tuple
+
+POSITION_FIELDS = ('symbol', 'exchange', 'product', 'side', 'quantity', 'ltp',
+        'net_amount', 'realized_mtm', 'average_buy_price', 'average_sell_price',
+        'instrument_token')
+
+ORDER_FIELDS = ('oms_order_id', 'symbol', 'exchange', 'product', 'side',
+        'order_type', 'status', 'quantity', 'price', 'trigger_price',
+        'leg_order_indicator', 'validity', 'instrument_token')
+
+
+class Record(Mapping):
+    """
+    Read only record with the fields of a broker response;
+    can be used wherever the response dictionary was used
+    """
+    __slots__ = ('_extra',)
+    FIELDS:Tuple[str, ...] = ()
+
+    def __init__(self, data:Dict):
+        """
+        data
+            dictionary from the broker
+        """
+        fields = self._field_set
+        extra = None
+        for k,v in data.items():
+            if k in fields:
+                object.__setattr__(self, k, v)
+            else:
+                if extra is None:
+                    extra = {}
+                extra[k] = v
+        object.__setattr__(self, '_extra', extra)
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._field_set = frozenset(cls.FIELDS)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is read only")
+
+    def __getitem__(self, key:str)->Any:
+        if key in self._field_set:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        if self._extra is not None and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def get(self, key:str, default:Any=None)->Any:
+        if key in self._field_set:
+            return getattr(self, key, default)
+        if self._extra is not None:
+            return self._extra.get(key, default)
+        return default
+
+    def __contains__(self, key)->bool:
+        if key in self._field_set:
+            return hasattr(self, key)
+        return self._extra is not None and key in self._extra
+
+    def __iter__(self)->Iterator[str]:
+        for f in self.FIELDS:
+            if hasattr(self, f):
+                yield f
+        if self._extra is not None:
+            yield from self._extra
+
+    def __len__(self)->int:
+        return sum(1 for _ in self)
+
+    def as_dict(self)->Dict[str, Any]:
+        return dict(self.items())
+
+    def __repr__(self)->str:
+        return f"{type(self).__name__}({self.as_dict()})"
+
+
+class Position(Record):
+    __slots__ = POSITION_FIELDS
+    FIELDS = POSITION_FIELDS
+
+
+class Order(Record):
+    __slots__ = ORDER_FIELDS
+    FIELDS = ORDER_FIELDS
+
+
+def to_records(cls, data):
+    """
+    Convert a list of dictionaries from the broker into records;
+    anything other than a list (an error response) is returned as is
+    """
+    if type(data) != list:
+        return data
+    return [cls(d) if isinstance(d, dict) else d for d in data]
+
+
+def json_default(obj):
+    """
+    Default for json.dumps serializing records as dictionaries
+    """
+    if isinstance(obj, Record):
+        return obj.as_dict()
+    return str(obj)
@@ -0,0 +1,174 @@
+"""
+In-memory report of positions and pending orders by symbol
+
+Aggregates are kept by symbol and updated incrementally
+whenever the positions of a user change. Only the contribution
+of the changed user is recomputed. Pending orders are taken
+from the levels of the order book
+"""
+import csv
+import threading
+from collections import defaultdict
+from typing import Any, Callable, Dict, List
+from orderbook import OrderBook, to_float
+
+# Columns of the report
+COLUMNS = ['symbol', 'side', 'quantity', 'average_buy_price', 'average_sell_price',
+        'net_amount', 'bep', 'ltp', 'limit_avg_price', 'sl_avg_price']
+
+# Average price of the order book level used for each order type
+ORDER_TYPES = {
+        'LIMIT': ('limit_avg_price', 'avg_price'),
+        'SL': ('sl_avg_price', 'avg_trigger_price')
+        }
+
+
+def position_totals(positions:List[Dict])->Dict[str, List[float]]:
+    """
+    Totals of positions by symbol as a list of
+    quantity, sum and count of average buy price,
+    sum and count of average sell price, net amount,
+    sum and count of ltp
+    """
+    totals = defaultdict(lambda: [0.0]*8)
+    for p in positions:
+        t = totals[p.get('symbol')]
+        t[0] += to_float(p.get('quantity'))
+        t[1] += to_float(p.get('average_buy_price'))
+        t[2] += 1
+        t[3] += to_float(p.get('average_sell_price'))
+        t[4] += 1
+        t[5] += to_float(p.get('net_amount'))
+        t[6] += to_float(p.get('ltp'))
+        t[7] += 1
+    return dict(totals)
+
+
+def _merge(target:Dict, totals:Dict, sign:int):
+    """
+    Add (sign=1) or subtract (sign=-1) totals from target
+    returns the keys changed
+    """
+    for key, values in totals.items():
+        current = target.setdefault(key, [0.0]*len(values))
+        for i, v in enumerate(values):
+            current[i] += sign*v
+        if sign < 0 and all(abs(v) < 1e-9 for v in current):
+            del target[key]
+    return set(totals.keys())
+
+
+class ReportEngine(object):
+    """
+    Report of positions and pending orders across users
+    """
+    def __init__(self, ltp:Callable=None, book:OrderBook=None):
+        """
+        ltp
+            function returning the last price of a symbol or None;
+            the mean ltp of the positions is used if not given
+        book
+            order book with the pending orders of all users;
+            a new book is created if not given
+        """
+        self._ltp = ltp
+        self._book = book or OrderBook()
+        self._lock = threading.Lock()
+        self._positions:Dict[str, List[float]] = {}
+        self._position_totals:Dict[str, Dict] = {}
+        self._version:int = 0
+        self._written_version = None
+        self._rows:List[Dict[str, Any]] = []
+        self._rows_version = None
+
+    @property
+    def version(self):
+        """
+        Changes every time the positions or the order book change
+        """
+        return (self._version, self._book.version)
+
+    def update_positions(self, client_id:str, positions:List[Dict]):
+        """
+        Replace the positions of a user
+        """
+        totals = position_totals(positions)
+        with self._lock:
+            old = self._position_totals.get(client_id, {})
+            if old == totals:
+                return
+            _merge(self._positions, old, -1)
+            _merge(self._positions, totals, 1)
+            self._position_totals[client_id] = totals
+            self._version += 1
+
+    def update_pending(self, client_id:str, orders:List[Dict]):
+        """
+        Replace the pending orders of a user in the order book;
+        not needed when the book is updated elsewhere
+        """
+        self._book.update(client_id, orders)
+
+    def rows(self)->List[Dict[str, Any]]:
+        """
+        Report with one row for each symbol and side having
+        both positions and pending orders
+        """
+        rows = self._aggregate()
+        if self._ltp is None:
+            return rows
+        live = []
+        for row in rows:
+            ltp = self._ltp(row['symbol'])
+            live.append(row if ltp is None else dict(row, ltp=ltp))
+        return live
+
+    def _aggregate(self)->List[Dict[str, Any]]:
+        with self._lock:
+            version = self.version
+            if self._rows_version == version:
+                return self._rows
+            by_symbol = defaultdict(dict)
+            for level in self._book.levels():
+                prices = by_symbol[(level['symbol'], level['side'])]
+                if level['order_type'] in ORDER_TYPES:
+                    column, price = ORDER_TYPES[level['order_type']]
+                    prices[column] = level[price]
+            rows = []
+            for (symbol, side), prices in sorted(by_symbol.items(), key=lambda x: str(x[0])):
+                t = self._positions.get(symbol)
+                if t is None:
+                    continue
+                quantity = t[0]
+                row = {
+                        'symbol': symbol,
+                        'side': side,
+                        'quantity': quantity,
+                        'average_buy_price': t[1]/t[2] if t[2] else None,
+                        'average_sell_price': t[3]/t[4] if t[4] else None,
+                        'net_amount': t[5],
+                        'bep': abs(round(t[5]/quantity, 2)) if quantity else None,
+                        'ltp': t[6]/t[7] if t[7] else None,
+                        'limit_avg_price': prices.get('limit_avg_price'),
+                        'sl_avg_price': prices.get('sl_avg_price')
+                        }
+                rows.append(row)
+            self._rows = rows
+            self._rows_version = version
+            return rows
+
+    def write_csv(self, filename:str, force:bool=False)->bool:
+        """
+        Write the report to a csv file if it changed since the last write
+        returns True if the file was written
+        """
+        version = self.version
+        if not(force) and version == self._written_version:
+            return False
+        rows = self.rows()
+        with open(filename, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=COLUMNS)
+            writer.writeheader()
+            writer.writerows(rows)
+        self._written_version = version
+        return True
@@ -0,0 +1,123 @@
+"""
+Background risk engine
+
+Computes the MTM of all users on every tick and exits
+all orders and positions of a user once the max loss,
+target or trailing stop of the user is breached
+"""
+import threading
+import time
+from typing import Dict, List, Any
+
+from fanout import FanOut
+from portfolio import Portfolio, fetch_positions
+from scheduler import EMERGENCY, ORDER
+from user import exit_users
+
+
+class RiskEngine(object):
+    """
+    Evaluate the exit rules of all users in a background thread
+    """
+    def __init__(self, users:List, fanout:FanOut, portfolio:Portfolio, tick:float=0.5):
+        """
+        users
+            list of users; users added later are picked up on the next tick
+        fanout
+            fan out pool used to fetch positions concurrently
+        portfolio
+            portfolio used to compute the mtm of all users
+        tick
+            seconds between two evaluations
+        """
+        self._users = users
+        self._fanout = fanout
+        self._portfolio = portfolio
+        self._tick:float = tick
+        self._breached = set()
+        self._triggers:List[Dict[str, Any]] = []
+        self._thread = None
+        self._stop = threading.Event()
+        self.ticks:int = 0
+        self.last_latency:float = 0
+        self.max_latency:float = 0
+        self.total_latency:float = 0
+
+    @property
+    def tick(self)->float:
+        return self._tick
+
+    @property
+    def is_running(self)->bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def _record(self, user):
+        client_id = user.broker.client_id
+        print(f"{client_id}|Risk breached|MTM:{int(user.mtm)}|Max MTM:{int(user.max_mtm)}")
+        self._triggers.append({
+            'client_id': client_id,
+            'timestamp': time.time(),
+            'mtm': user.mtm,
+            'max_mtm': user.max_mtm
+            })
+
+    def evaluate(self):
+        """
+        Evaluate all users once and exit the users
+        with a new breach
+        """
+        breached = []
+        users = list(self._users)
+        snapshots = fetch_positions(self._fanout, users, priority=ORDER)
+        self._portfolio.update(users, snapshots)
+        for user in users:
+            client_id = user.broker.client_id
+            if client_id not in snapshots:
+                continue
+            if user.must_exit_all:
+                if client_id not in self._breached:
+                    self._breached.add(client_id)
+                    breached.append(user)
+            else:
+                self._breached.discard(client_id)
+        if breached:
+            for user in breached:
+                self._record(user)
+            # Every leg of every breached user is sent at the same time
+            exit_users(self._fanout, breached, priority=EMERGENCY, brackets=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            start = time.monotonic()
+            try:
+                self.evaluate()
+            except Exception as e:
+                print(e)
+            latency = time.monotonic() - start
+            self.ticks += 1
+            self.last_latency = latency
+            self.max_latency = max(self.max_latency, latency)
+            self.total_latency += latency
+            self._stop.wait(max(0, self._tick - latency))
+
+    def start(self):
+        if not self.is_running:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='risk', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    @property
+    def stats(self)->Dict[str, Any]:
+        return {
+                'running': self.is_running,
+                'tick': self._tick,
+                'ticks': self.ticks,
+                'last_latency_ms': round(self.last_latency*1000, 3),
+                'avg_latency_ms': round(self.total_latency/self.ticks*1000, 3) if self.ticks else 0,
+                'max_latency_ms': round(self.max_latency*1000, 3),
+                'breached': sorted(self._breached),
+                'triggers': self._triggers
+                }
@@ -0,0 +1,148 @@
+"""
+Priority lanes for broker calls
+
+Every call is queued in one of three lanes.
+Workers always pick the call from the most urgent lane first
+and some workers are reserved for the urgent lanes so that
+an exit is never stuck behind a report or a poll
+"""
+import concurrent.futures
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, List, Any
+
+# Priority classes; lower is more urgent
+EMERGENCY = 0
+ORDER = 1
+READ = 2
+
+PRIORITY_NAMES = {
+        EMERGENCY: 'emergency',
+        ORDER: 'order',
+        READ: 'read'
+        }
+
+# Priority of the call running in the current thread
+_local = threading.local()
+
+
+def current_priority()->int:
+    """
+    Priority of the call being run by this thread;
+    READ outside the executor
+    """
+    return getattr(_local, 'priority', READ)
+
+
+class LaneStats(object):
+    """
+    Queue depth and wait time of a lane
+    """
+    def __init__(self):
+        self.submitted:int = 0
+        self.completed:int = 0
+        self.total_wait:float = 0
+        self.max_wait:float = 0
+
+    def as_dict(self, depth:int)->Dict[str, Any]:
+        started = self.submitted - depth
+        return {
+                'depth': depth,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'avg_wait_ms': round(self.total_wait/started*1000, 3) if started else 0,
+                'max_wait_ms': round(self.max_wait*1000, 3)
+                }
+
+
+class PriorityExecutor(object):
+    """
+    A thread pool with a queue per priority class
+    """
+    def __init__(self, shared:int=32, reserved:Dict[int,int]=None):
+        """
+        shared
+            number of workers serving all lanes
+        reserved
+            number of workers reserved for a lane;
+            a reserved worker serves its own lane and
+            the lanes more urgent than it
+        """
+        reserved = reserved or {}
+        self._lanes:List[deque] = [deque() for _ in PRIORITY_NAMES]
+        self._stats:List[LaneStats] = [LaneStats() for _ in PRIORITY_NAMES]
+        self._condition = threading.Condition()
+        self._shutdown:bool = False
+        self._threads:List[threading.Thread] = []
+        workers = [(READ, shared)] + list(reserved.items())
+        for lane, count in workers:
+            for i in range(count):
+                name = f"{PRIORITY_NAMES[lane]}_{i}"
+                t = threading.Thread(target=self._work, args=(lane,), name=name, daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    @property
+    def max_workers(self)->int:
+        return len(self._threads)
+
+    def submit(self, priority:int, func:Callable, *args, **kwargs)->concurrent.futures.Future:
+        """
+        Queue a call in the lane for the priority
+        returns a future
+        """
+        future = concurrent.futures.Future()
+        with self._condition:
+            if self._shutdown:
+                raise RuntimeError('cannot submit after shutdown')
+            self._lanes[priority].append((time.monotonic(), future, func, args, kwargs))
+            self._stats[priority].submitted += 1
+            self._condition.notify_all()
+        return future
+
+    def _next(self, lowest:int):
+        """
+        Pop the most urgent call upto the lowest lane
+        """
+        for priority in range(lowest+1):
+            if self._lanes[priority]:
+                return priority, self._lanes[priority].popleft()
+        return None, None
+
+    def _work(self, lowest:int):
+        while True:
+            with self._condition:
+                priority, task = self._next(lowest)
+                while task is None:
+                    if self._shutdown:
+                        return
+                    self._condition.wait()
+                    priority, task = self._next(lowest)
+            queued, future, func, args, kwargs = task
+            stats = self._stats[priority]
+            wait = time.monotonic() - queued
+            stats.total_wait += wait
+            stats.max_wait = max(stats.max_wait, wait)
+            if future.set_running_or_notify_cancel():
+                _local.priority = priority
+                try:
+                    future.set_result(func(*args, **kwargs))
+                except BaseException as e:
+                    future.set_exception(e)
+                finally:
+                    _local.priority = READ
+            stats.completed += 1
+
+    @property
+    def stats(self)->Dict[str, Dict]:
+        return {PRIORITY_NAMES[priority]: self._stats[priority].as_dict(len(lane))
+                for priority, lane in enumerate(self._lanes)}
+
+    def shutdown(self):
+        with self._condition:
+            self._shutdown = True
+            for lane in self._lanes:
+                while lane:
+                    lane.popleft()[1].cancel()
+            self._condition.notify_all()
@@ -1,19 +1,54 @@
-from fastbt.brokers.master_trust import fetch_all_contracts
-from user import load_all_users, load_shortcuts
-from copy import deepcopy
-import pandas as pd
+from user import User, load_all_users, load_shortcuts, exit_lanes, AUTH_STATUS
+from fanout import FanOut
+from scheduler import EMERGENCY, ORDER, READ
+from risk import RiskEngine
+from triggers import TriggerEngine
+from ticks import TickCache, StreamFeed, ReplayFeed, update_from_positions
+from portfolio import Portfolio, fetch_positions
+from plan import ArgsParser, OrderPlan
+from settings import FANOUT_WORKERS, FANOUT_TIMEOUT, EMERGENCY_WORKERS, ORDER_WORKERS
+from settings import RISK_TICK, DEFAULT_LOT_SIZE, CONTRACTS_DIR
+from settings import STREAM_INTERVAL, KEEPALIVE_INTERVAL, BOOK_LINGER
+from settings import JOURNAL_DIR, JOURNAL_FLUSH_INTERVAL
+from settings import TICK_STREAM_URL, TICK_MAX_AGE, COALESCE_WINDOW
+from settings import BROKER_RATE, BROKER_BURST, GLOBAL_BROKER_RATE, GLOBAL_BROKER_BURST
+from contracts import ContractStore
+from stream import Publisher, Refresher
+from sessions import Warmer
+from metrics import REGISTRY, PARSE, record_fanout
+from singleflight import SingleFlight
+from ratelimit import RateLimiter
+from journal import Journal
+from report_engine import ReportEngine
+from orderbook import OrderBook
+import atexit
 import json
-import concurrent.futures
 import time
 import requests
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, has_request_context
+from flask.json.provider import DefaultJSONProvider
+from records import Record
+
+
+class JSONProvider(DefaultJSONProvider):
+    """
+    Serialize position and order records as dictionaries
+    """
+    @staticmethod
+    def default(obj):
+        if isinstance(obj, Record):
+            return obj.as_dict()
+        return DefaultJSONProvider.default(obj)
+
 app = Flask(__name__)
+app.json = JSONProvider(app)
 
 """
 Routes
 ------
 order(varargs):
+batch(varargs):
 bracket(varargs):
 bracket_stop(symbol, stop):
 bracket_target(symbol, target):
@@ -26,14 +61,36 @@ normal_target(symbol, price):
 mis_target(symbol, price):
 stop_and_buy(symbol, opposite):
 pending():
+order_book():
+order_book_orders():
 positions():
 exit_all():
 cancel_all_orders():
 mtm():
+mtm_by_symbol():
+cache_stats():
+coalesce_stats():
+throttle_stats():
+scheduler_stats():
+risk_stats():
+add_trigger(kind, symbol, price):
+move_trigger(trigger_id, price):
+cancel_trigger(trigger_id):
+list_triggers():
+tick(symbol, price):
+tick_stats():
+replay_ticks():
+auth_status():
+stream():
+session_stats():
+metrics():
+journal_stats():
+stream_stats():
 delay():
 all_users():
 disable_user(client_id):
 enable_user(client_id):
+write_report():
 report():
 modify(varargs):
 cancel(varargs):
@@ -42,15 +99,222 @@ To exit the first order only, add ?mode=first like
 /be/symbol/stop?first=True
 """
 
-contracts = fetch_all_contracts(exchanges=['NSE', 'NFO'])
-USERS = load_all_users()
-for user in USERS:
-    user.broker.contracts = contracts
+CONTRACTS = ContractStore(directory=CONTRACTS_DIR, exchanges=['NSE', 'NFO'],
+        default_lot_size=DEFAULT_LOT_SIZE).load()
+USERS = []
+TICKS = TickCache(CONTRACTS.tokens)
+LIMITER = RateLimiter(rate=BROKER_RATE, burst=BROKER_BURST,
+        global_rate=GLOBAL_BROKER_RATE, global_burst=GLOBAL_BROKER_BURST)
+PUBLISHER = Publisher()
+BOOK = OrderBook()
+REPORT = ReportEngine(ltp=TICKS.ltp, book=BOOK)
+JOURNAL = Journal(directory=JOURNAL_DIR, flush_interval=JOURNAL_FLUSH_INTERVAL)
+JOURNAL.start()
+atexit.register(JOURNAL.close)
+
+@app.before_request
+def journal_request():
+    # varargs are journaled as received; parsing them here
+    # would add to every order and warm the parser cache
+    args = request.view_args or {}
+    JOURNAL.write('request', route=request.endpoint, method=request.method,
+            path=request.full_path, remote_addr=request.remote_addr,
+            client_id=args.get('client_id') or request.args.get('client_id'),
+            symbol=args.get('symbol'), varargs=args.get('varargs'))
+
+def publish_snapshot(user, name, data):
+    client_id = user.broker.client_id
+    if PUBLISHER.publish(name, client_id, data):
+        if name == 'positions':
+            update_from_positions(TICKS, data, max_age=TICK_MAX_AGE)
+            REPORT.update_positions(client_id, data)
+        elif name == 'pending':
+            BOOK.update(client_id, data)
+
+def add_user(user):
+    """
+    Attach the contracts and start routing orders to the user
+    """
+    user.contracts = CONTRACTS
+    user.ticks = TICKS
+    user.limiter = LIMITER
+    user.broker.contracts = CONTRACTS.tokens
     user.broker.exchange = 'NFO'
+    user.add_listener(publish_snapshot)
+    user.journal = JOURNAL
+    USERS.append(user)
+
+for user in load_all_users(on_ready=add_user, journal=JOURNAL):
+    add_user(user)
 
 shortcuts = load_shortcuts()
+PARSER = ArgsParser(shortcuts)
 print(USERS)
 DISABLED_USERS = set()
+FANOUT = FanOut(max_workers=FANOUT_WORKERS, timeout=FANOUT_TIMEOUT,
+        reserved={EMERGENCY: EMERGENCY_WORKERS, ORDER: ORDER_WORKERS})
+
+# Priority class of the broker calls made by each route;
+# routes not listed here are read only and run as READ
+ROUTE_PRIORITY = {
+        'exit_all': EMERGENCY,
+        'cancel_all_orders': EMERGENCY,
+        'nrml_exit': EMERGENCY,
+        'mis_exit': EMERGENCY,
+        'tick': EMERGENCY,
+        'bracket_exit': EMERGENCY,
+        'order': ORDER,
+        'batch': ORDER,
+        'bracket': ORDER,
+        'bracket_stop': ORDER,
+        'bracket_target': ORDER,
+        'nrml_stop': ORDER,
+        'mis_stop': ORDER,
+        'nrml_target': ORDER,
+        'mis_target': ORDER,
+        'stop_and_buy': ORDER,
+        'modify': ORDER,
+        'cancel': ORDER,
+        }
+
+def route_priority(endpoint:str)->int:
+    """
+    Priority class of the route
+    """
+    return ROUTE_PRIORITY.get(endpoint, READ)
+
+def publish_mtm(portfolio):
+    for record in portfolio.user_records():
+        PUBLISHER.publish('mtm', record['client_id'], record)
+
+def refresh_pending(refresh_all:bool=True):
+    """
+    Fetch the pending orders of all users or only
+    of the users whose orders were changed
+    """
+    users = [user for user in USERS if refresh_all or user.pending_changed]
+    if users:
+        FANOUT.map(User.pending_orders, users, priority=READ)
+
+PORTFOLIO = Portfolio(ticks=TICKS)
+PORTFOLIO.add_listener(publish_mtm)
+TRIGGERS = TriggerEngine(USERS, FANOUT)
+TICKS.add_listener(TRIGGERS.on_tick)
+if TICK_STREAM_URL:
+    StreamFeed(TICKS, TICK_STREAM_URL).start()
+RISK = RiskEngine(USERS, FANOUT, PORTFOLIO, tick=RISK_TICK)
+RISK.start()
+REFRESHER = Refresher(PUBLISHER, refresh_pending, interval=STREAM_INTERVAL, linger=BOOK_LINGER)
+REFRESHER.start()
+
+def warm_sessions():
+    idle = [user for user in USERS if user.session_stats['idle'] >= KEEPALIVE_INTERVAL]
+    if idle:
+        FANOUT.map(User.warm, idle, priority=READ)
+
+WARMER = Warmer(warm_sessions, interval=KEEPALIVE_INTERVAL)
+WARMER.start()
+
+# Identical read requests in flight share one fan-out
+COALESCE = SingleFlight(window=COALESCE_WINDOW)
+
+def load_positions():
+    """
+    Fetch the positions of all users and update the portfolio
+    returns positions keyed by client_id
+    """
+    def _load():
+        snapshots = fetch_positions(FANOUT, USERS, priority=READ)
+        PORTFOLIO.update(USERS, snapshots)
+        return snapshots
+    return COALESCE.do('positions', _load)
+
+def enabled_users():
+    """
+    Users not disabled from placing new orders
+    """
+    return [user for user in USERS if user not in DISABLED_USERS]
+
+def fan_out(func, *args, users=None, extend=False, tag=False, priority=None, user_of=None, **kwargs):
+    """
+    Call func(user, *args, **kwargs) for all users concurrently
+    and return the list of non-empty responses in the order of users
+    func
+        function taking the user as the first argument
+    users
+        list of users; all users if None
+    extend
+        extend the responses with the result instead of appending
+    tag
+        return a response (or error) for every user
+        as a dictionary with the client_id
+    priority
+        priority class of the calls; derived from the route if None
+    user_of
+        function returning the user of an item when users
+        is a list of other items such as (user, leg) pairs
+    """
+    users = USERS if users is None else users
+    user_of = user_of or (lambda user: user)
+    responses = []
+    route = request.endpoint if has_request_context() else func.__name__
+    if priority is None:
+        priority = route_priority(route)
+    start = time.monotonic()
+    results = FANOUT.map(func, users, *args, priority=priority, **kwargs)
+    elapsed = time.monotonic() - start
+    print(f"{route}|users:{len(users)}|fan-out:{elapsed*1000:.1f}ms")
+    record_fanout(route, results, lambda item: user_of(item).broker.client_id)
+    if priority != READ:
+        # Orders may have changed; do not reuse earlier reads
+        # and refresh the pending orders of the book now
+        COALESCE.forget()
+        REFRESHER.wake()
+    for result in results:
+        client_id = user_of(result.item).broker.client_id
+        if tag:
+            if result.error:
+                responses.append({'client_id': client_id, 'error': str(result.error)})
+            else:
+                responses.append({'client_id': client_id, 'response': result.value})
+        elif result.error:
+            print(client_id, result.error)
+        elif result.value:
+            if extend:
+                responses.extend(result.value)
+            else:
+                responses.append(result.value)
+    return responses
+
+def order_lot_size(order_args)->int:
+    """
+    Lot size of the order; from the l argument
+    if given else from the contract master
+    """
+    exchange = order_args.get('exchange', 'NSE')
+    lot_size = CONTRACTS.lot_size(order_args.get('symbol'), exchange)
+    try:
+        lot_size = int(order_args.get('l', lot_size))
+    except Exception as e:
+        pass
+    return lot_size
+
+def place_order(user, plan):
+    """
+    Place the order of the plan for the user
+    """
+    payload = plan.payload(user)
+    if payload is None:
+        print("segment not allowed")
+        return {"message": "segment not allowed"}
+    return user.order_place(**payload)
+
+def send_by_conditions(user, method, conditions, *args, **kwargs):
+    """
+    Send a request changing the pending orders matching the conditions;
+    the broker method matches them on the orders it fetches itself
+    """
+    return user.send(method, *args, **conditions, **kwargs)
 
 def transform(varargs):
     """
@@ -59,17 +323,8 @@ def transform(varargs):
     varargs
         varargs as a string
     """
-    args = varargs.split('/')
-    text = [txt.split('=') for txt in args]
-    dct = {x:y for x,y in text}
-    dct2 = {}
-    for k,v in dct.items():
-        sc = shortcuts.get(k)
-        if sc:
-            dct2[sc] = v
-        else:
-            dct2[k] = v
-    return dct2
+    with PARSE.time(request.endpoint):
+        return dict(PARSER.parse(varargs))
 
 @app.route('/')
 def hello_world():
@@ -109,54 +364,61 @@ def order(varargs):
     """
     Place a MIS order
     """
-    responses = []
-    order_args = transform(varargs)
-    exchange = order_args.get('exchange', 'NSE')
-    try:
-        lot_size = int(order_args.get('l', 50))
-        num = int(order_args.get('n', 0))
-    except Exception as e:
-        lot_size = 50
-        num = 0
-    def _place_order(user, args):
-        if user not in DISABLED_USERS:
-            if exchange in user.allowed_segments:
-                kwargs = deepcopy(args)
-                quantity = user.quantity(kwargs.get('quantity', 0))
-                quantity = round(quantity/lot_size)*lot_size
-                kwargs['quantity'] = quantity
-                response = user.broker.order_place(**kwargs)
-                print(user.broker.client_id, time.monotonic())
-            else:
-                print("segment not allowed")
-                response = {"message": "segment not allowed"}
-            return response
-    with concurrent.futures.ThreadPoolExecutor(max_workers=6) as executor:
-        futures = {executor.submit(_place_order, user, order_args) for user in USERS}
-        for future in concurrent.futures.as_completed(futures):
-            try:
-                data = future.result()
-                if data:
-                    responses.append(data)
-            except Exception as e:
-                print(e)
+    with PARSE.time('order'):
+        order_args = PARSER.parse(varargs)
+    users = enabled_users()
+    plan = OrderPlan(order_args, users, lot_size=order_lot_size(order_args))
+    responses = fan_out(place_order, plan, users=users)
     return jsonify(responses)
 
 
+@app.route('/batch', methods=['POST'])
+@app.route('/batch/<path:varargs>', methods=['GET'])
+def batch(varargs=None):
+    """
+    Place many orders (legs) for all users in a single fan-out
+    legs are separated by ; in the url like
+    /batch/sym=NIFTY22JUN16000CE/qty=50/side=SELL;sym=NIFTY22JUN16000PE/qty=50/side=SELL
+    or posted as json like {"legs": [{"sym": "NIFTY22JUN16000CE", "qty": 50}, ...]}
+    where each leg is either a dictionary or a string in the url form
+    returns the response of each leg keyed by client_id
+    """
+    with PARSE.time('batch'):
+        if varargs is None:
+            body = request.get_json(silent=True)
+            legs = body.get('legs') if isinstance(body, dict) else None
+            if not isinstance(legs, list) or not all(isinstance(leg, (str, dict)) for leg in legs):
+                return 'body must be like {"legs": [...]} with each leg a dictionary or string', 400
+            legs = [PARSER.parse(leg) if isinstance(leg, str) else PARSER.parse_dict(leg)
+                    for leg in legs]
+        else:
+            legs = [PARSER.parse(leg) for leg in varargs.split(';') if leg]
+    users = enabled_users()
+    plans = [OrderPlan(leg, users, lot_size=order_lot_size(leg)) for leg in legs]
+    # Every leg of every user is a separate call so that
+    # all legs are sent within the same dispatch window
+    items = [(user, plan) for user in users for plan in plans]
+    responses = fan_out(lambda item: place_order(*item), users=items, tag=True,
+            user_of=lambda item: item[0])
+    matrix = {user.broker.client_id: [] for user in users}
+    for response in responses:
+        matrix[response.pop('client_id')].append(response)
+    return jsonify(matrix)
+
+
 @app.route('/bracket/<path:varargs>', methods=['GET'])
 def bracket(varargs):
     """
     Place bracket order
     """
-    responses = []
-    order_args = transform(varargs)
-    for user in USERS:
-        if user not in DISABLED_USERS:
-            kwargs = deepcopy(order_args)
-            kwargs['quantity'] = user.quantity(kwargs.get('quantity', 0))
-            response = user.broker.place_bracket_order(**kwargs)
-            responses.append(response)
-    return str(responses)
+    with PARSE.time('bracket'):
+        order_args = PARSER.parse(varargs)
+    users = enabled_users()
+    plan = OrderPlan(order_args, users, check_segments=False)
+    def _place_bracket_order(user, plan):
+        return user.send('place_bracket_order', **plan.payload(user))
+    responses = fan_out(_place_bracket_order, plan, users=users, tag=True)
+    return jsonify(responses)
 
 
 @app.route('/bs/<symbol>/<stop>', methods=['GET'])
@@ -164,7 +426,6 @@ def bracket_stop(symbol, stop):
     """
     Modify stop loss of a bracket order by symbol
     """
-    responses = []
     first = request.args.get('first')
     p = int(request.args.get('p', 0))
     if first:
@@ -172,15 +433,7 @@ def bracket_stop(symbol, stop):
     else:
         first = False
     n = request.args.get('n', None)
-    with concurrent.futures.ThreadPoolExecutor(max_workers=len(USERS)) as executor:
-        futures = {executor.submit(user.broker.modify_bracket_stop, symbol,stop,first,p,n) for user in USERS}
-        for future in concurrent.futures.as_completed(futures):
-            try:
-                data = future.result()
-                if data:
-                    responses.append(data)
-            except Exception as e:
-                print(e)
+    responses = fan_out(User.send, 'modify_bracket_stop', symbol, stop, first, p, n)
     return jsonify(responses)
 
 @app.route('/bt/<symbol>/<target>', methods=['GET'])
@@ -188,7 +441,6 @@ def bracket_target(symbol, target):
     """
     Modify stop loss of a bracket order by symbol
     """
-    responses = []
     first = request.args.get('first')
     p = int(request.args.get('p', 0))
     if first:
@@ -196,15 +448,7 @@ def bracket_target(symbol, target):
     else:
         first = False
     n = request.args.get('n', None)
-    with concurrent.futures.ThreadPoolExecutor(max_workers=len(USERS)) as executor:
-        futures = {executor.submit(user.broker.modify_bracket_target, symbol,target,first,n,p) for user in USERS}
-        for future in concurrent.futures.as_completed(futures):
-            try:
-                data = future.result()
-                if data:
-                    responses.append(data)
-            except Exception as e:
-                print(e)
+    responses = fan_out(User.send, 'modify_bracket_target', symbol, target, first, n, p)
     return jsonify(responses)
 
 @app.route('/be/<symbol>', methods=['GET'])
@@ -212,22 +456,13 @@ def bracket_exit(symbol):
     """
     Modify stop loss of a bracket order by symbol
     """
-    responses = []
     first = request.args.get('first')
     p = int(request.args.get('p', 0))
     if first:
         first = True
     else:
         first = False
-    with concurrent.futures.ThreadPoolExecutor(max_workers=len(USERS)) as executor:
-        futures = {executor.submit(user.broker.exit_bracket_by_symbol,symbol,first,p) for user in USERS}
-        for future in concurrent.futures.as_completed(futures):
-            try:
-                data = future.result()
-                if data:
-                    responses.append(data)
-            except Exception as e:
-                print(e)
+    responses = fan_out(User.send, 'exit_bracket_by_symbol', symbol, first, p)
     return jsonify(responses)
 
 @app.route('/ne/<symbol>', methods=['GET'])
@@ -235,245 +470,284 @@ def nrml_exit(symbol):
     """
     Exit NRML order by symbol
     """
-    responses = []
     symbol = str(symbol).upper()
     percent = float(request.args.get('p', 1.0))
-    with concurrent.futures.ThreadPoolExecutor(max_workers=len(USERS)) as executor:
-        futures = {executor.submit(user.exit_position_by_symbol,symbol,percent,"NRML") for user in USERS}
-        for future in concurrent.futures.as_completed(futures):
-            try:
-                data = future.result()
-                if data:
-                    responses.append(data)
-            except Exception as e:
-                print(e)
-        return jsonify(responses)
+    responses = fan_out(User.exit_position_by_symbol, symbol, percent, "NRML")
+    return jsonify(responses)
 
 @app.route('/me/<symbol>', methods=['GET'])
 def mis_exit(symbol):
     """
     Exit MIS order by symbol
     """
-    responses = []
     symbol = str(symbol).upper()
     percent = float(request.args.get('p', 1.0))
-    with concurrent.futures.ThreadPoolExecutor(max_workers=len(USERS)) as executor:
-        futures = {executor.submit(user.exit_position_by_symbol,symbol,percent,"MIS") for user in USERS}
-        for future in concurrent.futures.as_completed(futures):
-            try:
-                data = future.result()
-                if data:
-                    responses.append(data)
-            except Exception as e:
-                print(e)
-        return jsonify(responses)
+    responses = fan_out(User.exit_position_by_symbol, symbol, percent, "MIS")
+    return jsonify(responses)
 
 @app.route('/ns/<symbol>/<trigger_price>', methods=['GET'])
 def nrml_stop(symbol, trigger_price):
     """
     Stop for NRML order by symbol
     """
-    responses = []
     symbol = str(symbol).upper()
     trigger_price = float(trigger_price)
     percent = float(request.args.get('p', 1.0))
-    with concurrent.futures.ThreadPoolExecutor(max_workers=len(USERS)) as executor:
-        futures = {executor.submit(user.stop_for_position_by_symbol,symbol,trigger_price, percent,"NRML") for user in USERS}
-        for future in concurrent.futures.as_completed(futures):
-            try:
-                data = future.result()
-                if data:
-                    responses.append(data)
-            except Exception as e:
-                print(e)
-        return jsonify(responses)
+    responses = fan_out(User.stop_for_position_by_symbol, symbol, trigger_price, percent, "NRML")
+    return jsonify(responses)
 
 @app.route('/ms/<symbol>/<trigger_price>', methods=['GET'])
 def mis_stop(symbol, trigger_price):
     """
     Exit MIS order by symbol
     """
-    responses = []
     symbol = str(symbol).upper()
     trigger_price = float(trigger_price)
     percent = float(request.args.get('p', 1.0))
-    with concurrent.futures.ThreadPoolExecutor(max_workers=len(USERS)) as executor:
-        futures = {executor.submit(user.stop_for_position_by_symbol,symbol,trigger_price,percent,"MIS") for user in USERS}
-        for future in concurrent.futures.as_completed(futures):
-            try:
-                data = future.result()
-                if data:
-                    responses.append(data)
-            except Exception as e:
-                print(e)
-        return jsonify(responses)
+    responses = fan_out(User.stop_for_position_by_symbol, symbol, trigger_price, percent, "MIS")
+    return jsonify(responses)
 
 @app.route('/nt/<symbol>/<price>', methods=['GET'])
 def nrml_target(symbol, price):
     """
     target NRML order by symbol
     """
-    responses = []
     symbol = str(symbol).upper()
     price = float(price)
     percent = float(request.args.get('p', 1.0))
-    with concurrent.futures.ThreadPoolExecutor(max_workers=len(USERS)) as executor:
-        futures = {executor.submit(user.target_for_position_by_symbol,symbol,price,percent,"NRML") for user in USERS}
-        for future in concurrent.futures.as_completed(futures):
-            try:
-                data = future.result()
-                if data:
-                    responses.append(data)
-            except Exception as e:
-                print(e)
-        return jsonify(responses)
+    responses = fan_out(User.target_for_position_by_symbol, symbol, price, percent, "NRML")
+    return jsonify(responses)
 
 @app.route('/mt/<symbol>/<price>', methods=['GET'])
 def mis_target(symbol, price):
     """
     target MIS order by symbol
     """
-    responses = []
     symbol = str(symbol).upper()
     price = float(price)
     percent = float(request.args.get('p', 1.0))
-    with concurrent.futures.ThreadPoolExecutor(max_workers=len(USERS)) as executor:
-        futures = {executor.submit(user.target_for_position_by_symbol,symbol,price,percent,"MIS") for user in USERS}
-        for future in concurrent.futures.as_completed(futures):
-            try:
-                data = future.result()
-                if data:
-                    responses.append(data)
-            except Exception as e:
-                print(e)
-        return jsonify(responses)    
+    responses = fan_out(User.target_for_position_by_symbol, symbol, price, percent, "MIS")
+    return jsonify(responses)
 
 @app.route('/copy/<symbol>/<opposite>', methods=['GET'])
 def stop_and_buy(symbol, opposite):
     """
     Move MIS position by Symbol to new Symbol
     """
-    responses = []
     symbol = str(symbol).upper()
     opposite = str(opposite).upper()
     percent = float(request.args.get('p', 1.0))
-    with concurrent.futures.ThreadPoolExecutor(max_workers=len(USERS)) as executor:
-        futures = {executor.submit(user.stop_and_reverse,symbol,opposite, percent) for user in USERS}
-        for future in concurrent.futures.as_completed(futures):
-            try:
-                data = future.result()
-                if data:
-                    responses.append(data)
-            except Exception as e:
-                print(e)
-        return jsonify(responses)
+    responses = fan_out(User.stop_and_reverse, symbol, opposite, percent)
+    return jsonify(responses)
 
 @app.route('/pending')
 def pending():
-    lst = []
-    def get_pending_orders(user,timeout=1):
-        return user.broker.pending_orders()
-    users = [user for user in USERS]
-    with concurrent.futures.ThreadPoolExecutor(max_workers=6) as executor:
-        future_to_result = {executor.submit(get_pending_orders,user) for user in USERS}
-        for future in concurrent.futures.as_completed(future_to_result):
-            try:
-                data = future.result()
-                if data:
-                    lst.extend(data)
-            except Exception as e:
-                print(e)
+    lst = COALESCE.do('pending', fan_out, User.pending_orders, extend=True)
     return jsonify(lst)
 
+@app.route('/book')
+def order_book():
+    """
+    Pending orders of all users by symbol, side and order type
+    filter with ?symbol=NIFTY22JUNFUT&side=BUY&order_type=SL
+    """
+    watch_book()
+    return jsonify(BOOK.levels(**book_filters()))
+
+@app.route('/book/orders')
+def order_book_orders():
+    """
+    Pending orders of each user with the same filters as /book
+    and ?client_id= for a single user
+    """
+    watch_book()
+    return jsonify(BOOK.orders(client_id=request.args.get('client_id'), **book_filters()))
+
+def watch_book():
+    """
+    Keep the book updated by the refresher; the pending
+    orders are fetched here only if it was not running
+    """
+    if not REFRESHER.active:
+        refresh_pending()
+    REFRESHER.touch()
+
+def book_filters():
+    filters = {k: request.args.get(k) for k in ('symbol', 'side', 'order_type')}
+    if filters['side']:
+        filters['side'] = filters['side'].upper()
+    return filters
+
 @app.route('/positions')
 def positions():
     lst = []
-    statuses = []
-    all_mtm = 0
-    users = [user for user in USERS]
-    def check_and_close(user, timeout=1):
-        pos = user.broker.positions()
-        if type(pos) == list:
-            lst.extend(user.broker.positions())
-            mtm = user.broker.mtm(pos)
-            user.update_mtm(mtm)
-            client_id = user.broker.client_id
-            max_mtm = user.max_mtm
-            dd = (max_mtm-mtm)/(max_mtm+1)
-            print(f"{client_id}|Current PnL:{int(mtm)}|Max PnL:{int(max_mtm)}|DD:{dd :.2f}%")
-            if user.must_exit_all:
-                if user.broker.pending_orders():
-                    print('Triggering panic - closing all BO orders')
-                    user.exit_all_bracket_orders()
-                    user.broker.cancel_all_orders_by_conditions()
-                    #requests.get(f"http://127.0.0.1:8181/disable/{client_id}")
-                else:
-                    print('No pending orders to exit')
-                user.exit_all_positions()
-            return pos
-    with concurrent.futures.ThreadPoolExecutor(max_workers=len(users)) as executor:
-        future_to_result = {executor.submit(check_and_close, user) for user in USERS}
-        for future in concurrent.futures.as_completed(future_to_result):
-            try:
-                data = future.result()
-                if data:
-                    statuses.extend(data)
-                    all_mtm += user.broker.mtm(data)
-            except Exception as e:
-                print(e)
-    print(f"Combined MTM: {int(all_mtm)}")
+    snapshots = load_positions()
+    for pos in snapshots.values():
+        lst.extend(pos)
+    for row in PORTFOLIO.user_records():
+        mtm, max_mtm, dd = row['mtm'], row['max_mtm'], row['drawdown']
+        print(f"{row['client_id']}|Current PnL:{int(mtm)}|Max PnL:{int(max_mtm)}|DD:{dd :.2f}%")
+    print(f"Combined MTM: {int(PORTFOLIO.total)}")
     return jsonify(lst)
 
 @app.route('/panic')
 def exit_all():
-    # Exit all positions for all users
-    users = [user for user in USERS]
-    responses = []
-    with concurrent.futures.ThreadPoolExecutor(max_workers=len(users)) as executor:
-        future_to_result = {executor.submit(user.exit_all_positions) for user in USERS}
-        for future in concurrent.futures.as_completed(future_to_result):
-            try:
-                data = future.result()
-                if data:
-                    responses.extend(data)
-            except Exception as e:
-                print(e)
-    return jsonify(responses)
+    # Exit all positions for all users; the positions of all
+    # users are sent together like the legs of /batch with
+    # at most EXIT_LEGS_PER_ACCOUNT orders of a user at a time
+    legs = fan_out(lambda user: [(user, leg) for leg in user.position_exits()], extend=True)
+    outcomes = fan_out(lambda lane: [lane[0].exit_position_leg(leg) for leg in lane[1]],
+            users=exit_lanes(legs), extend=True, user_of=lambda lane: lane[0])
+    return jsonify(outcomes)
 
 @app.route('/cancel_all')
 def cancel_all_orders():
     # Cancel all pending orders for all users
-    users = [user for user in USERS]
-    responses = []
-    with concurrent.futures.ThreadPoolExecutor(max_workers=len(users)) as executor:
-        future_to_result = {executor.submit(user.broker.cancel_all_orders) for user in USERS}
-        for future in concurrent.futures.as_completed(future_to_result):
-            try:
-                data = future.result()
-                if data:
-                    responses.extend(data)
-            except Exception as e:
-                print(e)
+    responses = fan_out(User.send, 'cancel_all_orders', extend=True)
     return jsonify(responses)
 
 @app.route('/mtm')
 def mtm():
-    lst =  []
-    for user in USERS:
-        try:
-            mtm = user.broker.mtm()
-            max_mtm = user.max_mtm
-            client_id = user.broker.client_id
-            dct = {
-                    'client_id': client_id,
-                    'mtm': mtm,
-                    'max_mtm': max_mtm
-                    }
-            lst.append(dct)
-        except Exception as e:
-            print(e)
+    load_positions()
+    lst = PORTFOLIO.user_records()
     return jsonify(lst)
 
+@app.route('/mtm/symbols')
+def mtm_by_symbol():
+    # MTM of each symbol across all users as of the last update
+    return jsonify(PORTFOLIO.symbol_records())
+
+@app.route('/cache')
+def cache_stats():
+    # Snapshot cache hits and misses for all users
+    return jsonify({user.broker.client_id: user.cache_stats for user in USERS})
+
+@app.route('/coalesce')
+def coalesce_stats():
+    # Read requests executed, shared while in flight and reused after
+    return jsonify(COALESCE.stats)
+
+@app.route('/throttle')
+def throttle_stats():
+    # Tokens left for each account and calls waiting by priority
+    return jsonify(LIMITER.stats)
+
+@app.route('/scheduler')
+def scheduler_stats():
+    # Queue depth and wait time of each priority class
+    return jsonify(FANOUT.stats)
+
+@app.route('/risk')
+def risk_stats():
+    # Status and evaluation latency of the risk engine
+    return jsonify(RISK.stats)
+
+@app.route('/trigger/<kind>/<symbol>/<price>')
+def add_trigger(kind, symbol, price):
+    """
+    Exit positions of the symbol for all users at market
+    when the price crosses the level; kind is stop or target
+    add ?product=NRML&p=0.5 to exit half the NRML positions and
+    ?dir=below or ?dir=above if no price was received for the symbol
+    """
+    if kind not in ('stop', 'target'):
+        return f'kind must be stop or target not {kind}'
+    try:
+        trigger = TRIGGERS.add(symbol, float(price), kind=kind,
+                direction=request.args.get('dir'),
+                product=request.args.get('product', 'MIS').upper(),
+                percent=float(request.args.get('p', 1.0)))
+    except ValueError as e:
+        return str(e)
+    return jsonify(trigger._asdict())
+
+@app.route('/trigger/move/<int:trigger_id>/<price>')
+def move_trigger(trigger_id, price):
+    try:
+        return jsonify(TRIGGERS.move(trigger_id, float(price))._asdict())
+    except KeyError:
+        return f'No trigger {trigger_id}'
+    except ValueError as e:
+        return str(e)
+
+@app.route('/trigger/cancel/<int:trigger_id>')
+def cancel_trigger(trigger_id):
+    try:
+        return jsonify(TRIGGERS.cancel(trigger_id)._asdict())
+    except KeyError:
+        return f'No trigger {trigger_id}'
+
+@app.route('/triggers')
+def list_triggers():
+    # Levels not yet hit and the levels fired
+    return jsonify(dict(TRIGGERS.stats, levels=TRIGGERS.triggers(request.args.get('symbol'))))
+
+@app.route('/tick/<symbol>/<price>')
+def tick(symbol, price):
+    """
+    Update the last price of a symbol; for feeds and tests
+    add ?exchange=NSE for other exchanges
+    """
+    exchange = request.args.get('exchange', 'NFO')
+    TICKS.update_symbol(symbol, float(price), exchange)
+    return jsonify({'symbol': symbol, 'exchange': exchange, 'ltp': TICKS.ltp(symbol, exchange)})
+
+@app.route('/ticks')
+def tick_stats():
+    # Number of symbols with a price and updates received
+    return jsonify(TICKS.stats)
+
+@app.route('/ticks/replay')
+def replay_ticks():
+    """
+    Replay prices from a csv file with the columns timestamp, symbol and price
+    like /ticks/replay?file=ticks.csv&speed=10 to replay at 10 times the original pace
+    """
+    filename = request.args.get('file')
+    if not filename:
+        return 'file is mandatory'
+    speed = request.args.get('speed')
+    ReplayFeed(TICKS, filename, speed=float(speed) if speed else None).start()
+    return f"Replaying {filename}"
+
+@app.route('/auth')
+def auth_status():
+    # Authentication status and latency of each user
+    return jsonify(AUTH_STATUS)
+
+@app.route('/stream')
+def stream():
+    """
+    Stream changes in positions, pending orders and mtm
+    of all users as server sent events
+    """
+    subscriber = PUBLISHER.subscribe()
+    return Response(PUBLISHER.events(subscriber), mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache'})
+
+@app.route('/sessions')
+def session_stats():
+    """
+    Connection reuse and connect vs server time of broker calls by user
+    """
+    return jsonify({user.broker.client_id: user.session_stats for user in USERS})
+
+@app.route('/metrics')
+def metrics():
+    """
+    Latency histograms in the prometheus text format
+    """
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/journal')
+def journal_stats():
+    # Records queued and written by the journal
+    return jsonify(JOURNAL.stats)
+
+@app.route('/stream/stats')
+def stream_stats():
+    return jsonify(PUBLISHER.stats)
+
 @app.route('/delay')
 def delay():
     # Induce a delay for testing purpose
@@ -520,47 +794,31 @@ def enable_user(client_id):
     return jsonify([user.broker.client_id for user in enabled_users])
 
 @app.route('/write_report')
-def report():
-    def generate_report():
-        positions = pd.read_csv('reports/positions.csv')
-        pending = pd.read_csv('reports/pending.csv')
-        pending['value'] = [(trigger if trigger > 0 else price)*quantity for price,trigger,quantity in zip(pending.price, pending.trigger_price, pending.quantity)]
-        pos_grouped = positions.groupby(['symbol']).agg({
-            'quantity': sum,
-            'average_buy_price': 'mean',
-            'average_sell_price': 'mean',
-            'net_amount': sum,
-            'ltp': 'mean'
-            }).reset_index()
-        pos_grouped['bep'] = pos_grouped.eval('net_amount/quantity').round(2).abs()
-        pending_grouped = pending.groupby(['symbol', 'side',
-            'order_type']).agg({
-            'quantity': sum,
-            'value': sum,
-            })
-        pending_grouped['avg_price'] = pending_grouped.eval('value/quantity')
-
-        pending_grouped = pending_grouped.unstack(level='order_type').reset_index().rename(
-                    columns={'trading_symbol': 'symbol'})
-
-        grp = pos_grouped.merge(pending_grouped, on=['symbol'])
-        grp.index = grp.index+1
-        columns = ['symbol', 'quantity', 'bep', 'ltp', ('avg_price', 'LIMIT'),
-                ('avg_price', 'SL')]
-        columns = [col for col in columns if col in grp.columns]
-        grp[columns].to_csv('reports/reports.csv')
+def write_report():
+    """
+    Write reports/reports.csv if the report changed since the last write
+    add ?force=True to write it anyway
+    """
     try:
-        generate_report()
-        return f"Report generated succesfully"
+        if not PUBLISHER.state('pending'):
+            refresh_pending()
+        force = bool(request.args.get('force'))
+        if REPORT.write_csv('reports/reports.csv', force=force):
+            return f"Report generated succesfully"
+        return "Report unchanged"
     except Exception as e:
         return str(e)
 
+@app.route('/report')
+def report():
+    # Report of positions and pending orders by symbol
+    return jsonify(REPORT.rows())
+
 @app.route('/modify/<path:varargs>', methods=['GET'])
 def modify(varargs):
     """
     modify pending and open orders 
     """
-    responses = []
     filter_args = transform(varargs)
     side = filter_args.get('side','')
     side = side.upper()
@@ -588,11 +846,8 @@ def modify(varargs):
         modifications['quantity'] = quantity
     modifications['price' ] = price
     modifications['trigger_price'] = trigger_price
-    for user in USERS:
-        if user not in DISABLED_USERS:
-            response = user.broker.modify_all_orders_by_conditions(modifications,
-                    n=n,**filter_args)
-            responses.append(response)
+    responses = fan_out(send_by_conditions, 'modify_all_orders_by_conditions', filter_args,
+            modifications, n=n, users=enabled_users(), tag=True)
     return jsonify(responses)
 
 @app.route('/cancel/<path:varargs>', methods=['GET'])
@@ -600,7 +855,6 @@ def cancel(varargs):
     """
     Place a MIS order
     """
-    responses = []
     filter_args = transform(varargs)
     n = filter_args.pop('n', 0)
     exchange = filter_args.get('exchange','')
@@ -613,11 +867,8 @@ def cancel(varargs):
     side = side.upper()
     if (side != 'BUY') and (side!= 'SELL'):
         return f'side is mandatory or its incorrect {side}'
-    # Check for modifications
-    for user in USERS:
-        if user not in DISABLED_USERS:
-            response = user.broker.cancel_all_orders_by_conditions(n=n,**filter_args)
-            responses.append(response)
+    responses = fan_out(send_by_conditions, 'cancel_all_orders_by_conditions', filter_args,
+            n=n, users=enabled_users(), tag=True)
     return jsonify(responses)
 
 bo_string = "exc=NSE/sym=TATAPOWER-EQ/qty=4/val=DAY/sq_val=1/sl_val=1/pr=82.8/tsl=1/ot=LIMIT/prd=BO/side=BUY/user_order_id=10003"
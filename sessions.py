@@ -0,0 +1,242 @@
+"""
+Pooled keep-alive http sessions for broker calls
+
+The broker library sends every request through the requests
+module and opens a new connection each time. The module is
+replaced by a router that sends each request through the
+session of the user making the call, so that connections are
+reused; the time spent in opening connections is recorded
+separately from the time spent waiting for the broker
+"""
+import contextlib
+import sys
+import threading
+import time
+from typing import Any, Dict
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from scheduler import current_priority
+
+# Session of the current thread and the connect time of its request
+_local = threading.local()
+
+
+def _record_connect(elapsed:float):
+    _local.connects = getattr(_local, 'connects', 0) + 1
+    _local.connect_time = getattr(_local, 'connect_time', 0) + elapsed
+
+
+class TimedHTTPConnection(HTTPConnection):
+    def connect(self):
+        start = time.monotonic()
+        try:
+            super().connect()
+        finally:
+            _record_connect(time.monotonic() - start)
+
+
+class TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        # Includes the TLS handshake
+        start = time.monotonic()
+        try:
+            super().connect()
+        finally:
+            _record_connect(time.monotonic() - start)
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedAdapter(HTTPAdapter):
+    """
+    Adapter whose connections record the time taken to connect
+    """
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+                'http': TimedHTTPConnectionPool,
+                'https': TimedHTTPSConnectionPool
+                }
+
+
+class PooledSession(object):
+    """
+    Keep-alive session of a user with a pool of connections
+    """
+    def __init__(self, pool_size:int=4, account:str=None):
+        """
+        pool_size
+            maximum number of connections kept open to a host
+        account
+            client_id of the user whose rate limit is used
+        """
+        self._pool_size:int = pool_size
+        self.account:str = account
+        # Rate limiter of the broker requests; set by the user
+        self.limiter = None
+        self._session = requests.Session()
+        adapter = TimedAdapter(pool_connections=2, pool_maxsize=pool_size)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+        self._lock = threading.Lock()
+        self._last_used:float = time.monotonic()
+        self.calls:int = 0
+        self.connects:int = 0
+        self.connect_time:float = 0
+        self.server_time:float = 0
+        self.last:Dict[str, float] = {}
+
+    @property
+    def idle(self)->float:
+        """
+        Seconds since the last request
+        """
+        return time.monotonic() - self._last_used
+
+    def request(self, method:str, url:str, **kwargs)->requests.Response:
+        """
+        Send a request and record the connect and server time
+        """
+        _local.connects = 0
+        _local.connect_time = 0
+        start = time.monotonic()
+        try:
+            return self._session.request(method, url, **kwargs)
+        finally:
+            elapsed = time.monotonic() - start
+            connect_time = _local.connect_time
+            with self._lock:
+                self._last_used = time.monotonic()
+                self.calls += 1
+                self.connects += _local.connects
+                self.connect_time += connect_time
+                self.server_time += elapsed - connect_time
+                self.last = {
+                        'connect_ms': connect_time*1000,
+                        'server_ms': (elapsed-connect_time)*1000
+                        }
+
+    def warm(self, url:str):
+        """
+        Open or keep alive a connection to the host of the url
+        """
+        try:
+            self.request('HEAD', url, timeout=10)
+        except Exception as e:
+            print(e)
+
+    @contextlib.contextmanager
+    def activate(self):
+        """
+        Send the requests made by the broker library
+        in this thread through this session
+        """
+        previous = getattr(_local, 'session', None)
+        _local.session = self
+        try:
+            yield self
+        finally:
+            _local.session = previous
+
+    def close(self):
+        self._session.close()
+
+    @property
+    def stats(self)->Dict[str, Any]:
+        calls = self.calls or 1
+        return {
+                'pool_size': self._pool_size,
+                'calls': self.calls,
+                'connects': self.connects,
+                'avg_connect_ms': self.connect_time*1000/calls,
+                'avg_server_ms': self.server_time*1000/calls,
+                'last': self.last,
+                'idle': self.idle
+                }
+
+
+class SessionRouter(object):
+    """
+    Stands in for the requests module in the broker library;
+    requests are sent through the active session of the
+    thread or directly if there is none
+    """
+    def request(self, method:str, url:str, **kwargs)->requests.Response:
+        """
+        Send a request after waiting for a token of the account
+        of the session; a broker method may send many requests
+        like a GET followed by a PUT for each order
+        """
+        session = getattr(_local, 'session', None)
+        if session is None:
+            return requests.request(method, url, **kwargs)
+        if session.limiter is not None:
+            session.limiter.acquire(session.account, current_priority())
+        return session.request(method, url, **kwargs)
+
+    def get(self, url:str, **kwargs)->requests.Response:
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url:str, **kwargs)->requests.Response:
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url:str, **kwargs)->requests.Response:
+        return self.request('PUT', url, **kwargs)
+
+    def delete(self, url:str, **kwargs)->requests.Response:
+        return self.request('DELETE', url, **kwargs)
+
+    def __getattr__(self, name:str):
+        return getattr(requests, name)
+
+
+def install(cls):
+    """
+    Route the requests of the module defining cls
+    through the active session
+    """
+    module = sys.modules[cls.__module__]
+    if not isinstance(getattr(module, 'requests', None), SessionRouter):
+        module.requests = SessionRouter()
+
+
+class Warmer(object):
+    """
+    Warm idle connections of all users in the background
+    """
+    def __init__(self, warm, interval:float=60):
+        """
+        warm
+            function called to warm the connections
+        interval
+            seconds between two calls
+        """
+        self._warm = warm
+        self._interval:float = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            try:
+                self._warm()
+            except Exception as e:
+                print(e)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='warmer', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
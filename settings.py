@@ -0,0 +1,89 @@
+"""
+Settings shared by the server and the user modules
+"""
+
+# Seconds for which positions and pending orders of a user
+# are reused before fetching them again from the broker
+CACHE_TTL = 1.0
+
+# Number of threads used to send requests to all users
+FANOUT_WORKERS = 32
+
+# Additional threads reserved for emergency exits
+# and for placing and modifying orders
+EMERGENCY_WORKERS = 8
+ORDER_WORKERS = 8
+
+# Number of exit orders of an account sent to the broker
+# at the same time by /panic and the risk engine
+EXIT_LEGS_PER_ACCOUNT = 4
+
+# Seconds to wait for a user's broker call in a request
+FANOUT_TIMEOUT = 10
+
+# Number of threads handling read requests in the ASGI serving mode;
+# emergency and order routes have EMERGENCY_WORKERS and ORDER_WORKERS
+ASGI_WORKERS = 16
+
+# Seconds between two evaluations of max loss, target
+# and trailing stop by the risk engine
+RISK_TICK = 0.5
+
+# Lot size by exchange for symbols not in the contract master
+DEFAULT_LOT_SIZE = {'NFO': 50}
+
+# Directory for the daily snapshot of the contract master
+CONTRACTS_DIR = 'contracts'
+
+# Number of users authenticated at the same time at startup
+AUTH_WORKERS = 8
+
+# Seconds to wait for a user to be authenticated; users not
+# authenticated by then are marked failed. The server starts within
+# this time and users waiting for a free worker are added when ready
+AUTH_TIMEOUT = 30
+
+# Seconds between two refreshes of the pending orders of all users
+# while there are subscribers to the stream or readers of /book;
+# longer than CACHE_TTL so that it takes a small share of the
+# rate limit. Orders changed by the server are refreshed at once
+STREAM_INTERVAL = 5.0
+
+# Seconds for which pending orders are refreshed after the
+# last /book request when there are no subscribers
+BOOK_LINGER = 60
+
+# Maximum number of keep-alive connections to the broker for each user
+POOL_SIZE = 4
+
+# Seconds after which an idle connection of a user is
+# warmed again so that it is not closed by the broker
+KEEPALIVE_INTERVAL = 60
+
+# Url streaming prices as json lines; prices are taken
+# only from the positions if None
+TICK_STREAM_URL = None
+
+# Seconds for which a streamed price is preferred
+# over the last price of the positions
+TICK_MAX_AGE = 5
+
+# Directory of the daily journal of route calls and broker requests
+JOURNAL_DIR = 'journal'
+
+# Seconds between two batched writes of the journal
+JOURNAL_FLUSH_INTERVAL = 0.2
+
+# Seconds for which the result of /positions, /pending
+# or /mtm is reused by identical requests arriving after it
+COALESCE_WINDOW = 0.25
+
+# Broker http requests per second and burst allowed for each account;
+# requests over the limit wait instead of being rejected
+BROKER_RATE = 10
+BROKER_BURST = 10
+
+# Broker http requests per second and burst of all accounts together;
+# no global limit if None
+GLOBAL_BROKER_RATE = None
+GLOBAL_BROKER_BURST = None
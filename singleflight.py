@@ -0,0 +1,97 @@
+"""
+Coalescing of identical concurrent calls
+
+Callers with the same key while a call is in flight wait
+for it and share its result. The result is also reused by
+callers arriving within a short window after it completes
+"""
+import threading
+import time
+from typing import Any, Callable, Dict
+
+
+class _Call(object):
+    __slots__ = ('done', 'result', 'error', 'finished')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.finished:float = None
+
+
+class SingleFlight(object):
+    """
+    Share the result of a call among concurrent callers
+    """
+    def __init__(self, window:float=0.25):
+        """
+        window
+            seconds for which a completed result is reused
+        """
+        self._window:float = window
+        self._lock = threading.Lock()
+        self._calls:Dict[Any, _Call] = {}
+        self.executed:int = 0
+        self.shared:int = 0
+        self.reused:int = 0
+
+    @property
+    def window(self)->float:
+        return self._window
+
+    def do(self, key, func:Callable, *args, **kwargs):
+        """
+        Call func(*args, **kwargs) unless a call with the same
+        key is in flight or completed within the window
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                if not call.done.is_set():
+                    self.shared += 1
+                    leader = False
+                elif call.error is None and time.monotonic() - call.finished < self._window:
+                    self.reused += 1
+                    return call.result
+                else:
+                    call = None
+            if call is None:
+                call = self._calls[key] = _Call()
+                self.executed += 1
+                leader = True
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func(*args, **kwargs)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            call.finished = time.monotonic()
+            call.done.set()
+
+    def forget(self, key=None):
+        """
+        Drop the result of a key or of all keys so that the
+        next call is executed; a call still in flight is detached
+        and shared only by the callers that already joined it
+        """
+        with self._lock:
+            if key is None:
+                self._calls.clear()
+            else:
+                self._calls.pop(key, None)
+
+    @property
+    def stats(self)->Dict[str, Any]:
+        return {
+                'window': self._window,
+                'executed': self.executed,
+                'shared': self.shared,
+                'reused': self.reused
+                }
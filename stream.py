@@ -0,0 +1,220 @@
+"""
+Server side push of positions, pending orders and mtm
+
+Snapshots are published whenever they are fetched from the
+broker and only the snapshots that changed are pushed to
+subscribers as server sent events
+"""
+import json
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+from records import json_default
+
+# Topics published to subscribers
+TOPICS = ['positions', 'pending', 'mtm']
+
+# Comment sent to an idle subscriber
+HEARTBEAT = ": heartbeat\n\n"
+
+
+def event_text(topic:str, encoded:str)->str:
+    """
+    Server sent event of a snapshot
+    """
+    return f"event: {topic}\ndata: {encoded}\n\n"
+
+
+class Publisher(object):
+    """
+    Keep the latest snapshot of each topic by client_id and
+    push changes to all subscribers
+    """
+    def __init__(self, maxsize:int=1000, heartbeat:float=15):
+        """
+        maxsize
+            maximum number of events queued for a subscriber;
+            the oldest events are dropped for a slow subscriber
+        heartbeat
+            seconds after which a comment is sent to an idle subscriber
+        """
+        self._maxsize:int = maxsize
+        self._heartbeat:float = heartbeat
+        self._lock = threading.Lock()
+        self._state:Dict[str, Dict[str, Any]] = {topic: {} for topic in TOPICS}
+        self._encoded:Dict[Tuple[str, str], str] = {}
+        self._subscribers:List[queue.Queue] = []
+        self._notify:Dict[queue.Queue, Callable] = {}
+        self.published:int = 0
+        self.skipped:int = 0
+
+    @property
+    def num_subscribers(self)->int:
+        return len(self._subscribers)
+
+    @property
+    def heartbeat(self)->float:
+        return self._heartbeat
+
+    def state(self, topic:str)->Dict[str, Any]:
+        """
+        Latest snapshot of the topic keyed by client_id
+        """
+        return dict(self._state[topic])
+
+    def publish(self, topic:str, client_id:str, data:Any)->bool:
+        """
+        Publish a snapshot of a client
+        returns True if the snapshot changed and was pushed
+        """
+        encoded = json.dumps({'client_id': client_id, 'data': data},
+                sort_keys=True, default=json_default)
+        key = (topic, client_id)
+        with self._lock:
+            if self._encoded.get(key) == encoded:
+                self.skipped += 1
+                return False
+            self._encoded[key] = encoded
+            self._state[topic][client_id] = data
+            self.published += 1
+            for subscriber in self._subscribers:
+                self._put(subscriber, (topic, encoded))
+                notify = self._notify.get(subscriber)
+                if notify:
+                    notify()
+        return True
+
+    def _put(self, subscriber:queue.Queue, event:Tuple[str, str]):
+        while True:
+            try:
+                subscriber.put_nowait(event)
+                return
+            except queue.Full:
+                try:
+                    subscriber.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def subscribe(self, notify:Callable=None)->queue.Queue:
+        """
+        Subscribe to all topics; the current snapshots
+        are queued first
+        notify
+            function called without arguments after each event
+            is queued; it must not block
+        """
+        subscriber = queue.Queue(maxsize=self._maxsize)
+        with self._lock:
+            for (topic, client_id), encoded in self._encoded.items():
+                self._put(subscriber, (topic, encoded))
+            self._subscribers.append(subscriber)
+            if notify:
+                self._notify[subscriber] = notify
+        return subscriber
+
+    def unsubscribe(self, subscriber:queue.Queue):
+        with self._lock:
+            if subscriber in self._subscribers:
+                self._subscribers.remove(subscriber)
+            self._notify.pop(subscriber, None)
+
+    def events(self, subscriber:queue.Queue)->Iterator[str]:
+        """
+        Server sent events for the subscriber
+        """
+        try:
+            while True:
+                try:
+                    topic, encoded = subscriber.get(timeout=self._heartbeat)
+                    yield event_text(topic, encoded)
+                except queue.Empty:
+                    yield HEARTBEAT
+        finally:
+            self.unsubscribe(subscriber)
+
+    @property
+    def stats(self)->Dict[str, int]:
+        return {
+                'subscribers': self.num_subscribers,
+                'published': self.published,
+                'skipped': self.skipped
+                }
+
+
+class Refresher(object):
+    """
+    Refresh pending orders of all users in the background
+    while there are subscribers or readers of the snapshots;
+    positions are refreshed by the risk engine
+    """
+    def __init__(self, publisher:Publisher, refresh, interval:float=5.0, linger:float=60):
+        """
+        publisher
+            publisher whose subscribers are checked
+        refresh
+            function called with True to refresh all the snapshots
+            or with False to refresh only the snapshots changed since
+        interval
+            seconds between two refreshes of all the snapshots
+        linger
+            seconds to keep refreshing after the last touch
+            even if there are no subscribers
+        """
+        self._publisher = publisher
+        self._refresh = refresh
+        self._interval:float = interval
+        self._linger:float = linger
+        self._touched:float = None
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+
+    @property
+    def active(self)->bool:
+        """
+        True if the snapshots are being refreshed
+        """
+        if self._thread is None:
+            return False
+        if self._publisher.num_subscribers > 0:
+            return True
+        return self._touched is not None and time.monotonic() - self._touched < self._linger
+
+    def touch(self):
+        """
+        Keep refreshing for linger seconds from now
+        """
+        self._touched = time.monotonic()
+
+    def wake(self):
+        """
+        Refresh the changed snapshots now instead of
+        at the next interval; called after orders are changed
+        """
+        self._wake.set()
+
+    def _run(self):
+        last = time.monotonic()
+        while not self._stop.is_set():
+            self._wake.wait(max(0, self._interval - (time.monotonic() - last)))
+            self._wake.clear()
+            if self._stop.is_set():
+                return
+            refresh_all = time.monotonic() - last >= self._interval
+            if refresh_all:
+                last = time.monotonic()
+            if self.active:
+                try:
+                    self._refresh(refresh_all)
+                except Exception as e:
+                    print(e)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='refresher', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
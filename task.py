@@ -1,48 +1,98 @@
+import json
+import threading
 import requests
 import time
 import pendulum
 import pandas as pd
 
-# Change this time for fetching data
-REFRESH_INTERVAL = 10
+# Minimum seconds between two writes of the reports
+REFRESH_INTERVAL = 1
+
+# Seconds to wait before reconnecting to the server
+RECONNECT_INTERVAL = 5
 
 # Directory in which reports are saved
 REPORTS_DIR = 'reports'
 
-# URL's to fetch data
+# URL streaming the positions, pending orders and mtm of all users
+STREAM_URL = "http://127.0.0.1:8181/stream"
+
+# Topics to save; one csv file per topic
 URLS = [
         'positions',
         'pending',
         'mtm',
         ]
 
+# Latest snapshot of each topic by client_id
+state = {url: {} for url in URLS}
+changed = set()
+lock = threading.Lock()
+
 def save_csv_file(data, filename):
     """
-    Convert the file to csv format and save with the given filename
+    Convert the data to csv format and save with the given filename
     data
-        HTTP response with JSON
+        list of records
     filename
         filename to same
     """
-    json_data = data.json()
-    if type(json_data) == list:
-        df = pd.DataFrame(json_data)
-        df.index = df.index+1
-        df.to_csv(filename)
-    elif type(json_data) == dict:
-        s = pd.Series(json_data).to_csv(filename)
+    df = pd.DataFrame(data)
+    df.index = df.index+1
+    df.to_csv(filename)
+
+def read_events(response):
+    """
+    Parse server sent events from a streaming response
+    returns a generator of event name and data
+    """
+    event, data = None, []
+    for line in response.iter_lines(decode_unicode=True):
+        if not line:
+            if event and data:
+                yield event, json.loads('\n'.join(data))
+            event, data = None, []
+        elif line.startswith('event:'):
+            event = line[6:].strip()
+        elif line.startswith('data:'):
+            data.append(line[5:].strip())
+
+def write_reports():
+    """
+    Write the csv files of the topics changed since the last write
+    """
+    while True:
+        time.sleep(REFRESH_INTERVAL)
+        try:
+            with lock:
+                topics = list(changed)
+                changed.clear()
+                snapshots = {url: list(state[url].values()) for url in topics}
+            if not topics:
+                continue
+            for url, values in snapshots.items():
+                if url == 'mtm':
+                    data = values
+                else:
+                    data = [row for rows in values for row in rows]
+                save_csv_file(data, f"{REPORTS_DIR}/{url}.csv")
+            print(pendulum.now(), topics)
+            # Write report already creates a csv file
+            req = requests.get("http://127.0.0.1:8181/write_report")
+            print(req.text)
+        except Exception as e:
+            print(e)
+
+threading.Thread(target=write_reports, daemon=True).start()
 
 while True:
     try:
-        for url in URLS:
-            response = requests.get(f"http://127.0.0.1:8181/{url}")
-            filename = f"{REPORTS_DIR}/{url}.csv"
-            save_csv_file(response, filename)
-            print(pendulum.now())
-        # Write report already creates a csv file
-        req = requests.get("http://127.0.0.1:8181/write_report")
-        print(req.text)
-        time.sleep(REFRESH_INTERVAL)
+        with requests.get(STREAM_URL, stream=True) as response:
+            for event, data in read_events(response):
+                if event in state:
+                    with lock:
+                        state[event][data['client_id']] = data['data']
+                        changed.add(event)
     except Exception as e:
-        print(e, url)
-
+        print(e)
+    time.sleep(RECONNECT_INTERVAL)
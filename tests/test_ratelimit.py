@@ -0,0 +1,57 @@
+import threading
+import time
+
+from ratelimit import TokenBucket, RateLimiter
+from scheduler import EMERGENCY, READ
+from sessions import PooledSession, SessionRouter
+
+
+def test_bucket_refills_at_rate_upto_capacity():
+    bucket = TokenBucket(rate=10, capacity=5)
+    now = time.monotonic()
+    bucket.refill(now)
+    bucket.tokens = 0
+    bucket.refill(now + 0.2)
+    assert abs(bucket.tokens - 2) < 1e-6
+    assert abs(bucket.wait_time()) < 1e-6
+    bucket.refill(now + 10)
+    assert bucket.tokens == 5
+
+
+def test_wait_time_of_an_empty_bucket():
+    bucket = TokenBucket(rate=4, capacity=1)
+    bucket.refill(time.monotonic())
+    bucket.tokens = 0
+    assert abs(bucket.wait_time() - 0.25) < 1e-6
+
+
+def test_urgent_calls_go_before_waiting_reads():
+    limiter = RateLimiter(rate=20, burst=1)
+    limiter.acquire('C0')
+    order = []
+    def call(priority, name):
+        limiter.acquire('C0', priority)
+        order.append(name)
+    read = threading.Thread(target=call, args=(READ, 'read'))
+    read.start()
+    time.sleep(0.01)
+    exit = threading.Thread(target=call, args=(EMERGENCY, 'exit'))
+    exit.start()
+    read.join(1)
+    exit.join(1)
+    assert order == ['exit', 'read']
+
+
+def test_every_request_of_a_broker_call_takes_a_token():
+    limiter = RateLimiter(rate=1000, burst=1000)
+    session = PooledSession(account='C0')
+    session.limiter = limiter
+    session.request = lambda method, url, **kwargs: method
+    router = SessionRouter()
+    def modify_all_orders():
+        # One GET of the orders and a PUT for each order
+        return [router.get('http://broker/orders')] + [router.put('http://broker/order') for _ in range(3)]
+    with session.activate():
+        assert modify_all_orders() == ['GET', 'PUT', 'PUT', 'PUT']
+    assert limiter.calls == 4
+    assert limiter.stats['tokens']['C0'] < 1000
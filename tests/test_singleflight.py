@@ -0,0 +1,27 @@
+import threading
+
+from singleflight import SingleFlight
+
+
+def test_forget_detaches_a_call_in_flight():
+    flight = SingleFlight(window=10)
+    started, release = threading.Event(), threading.Event()
+    values = iter(['before', 'after'])
+    def fetch():
+        value = next(values)
+        if value == 'before':
+            started.set()
+            release.wait(1)
+        return value
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flight.do('positions', fetch)))
+    leader.start()
+    assert started.wait(1)
+    # An order changed the positions while the read was in flight
+    flight.forget()
+    assert flight.do('positions', fetch) == 'after'
+    release.set()
+    leader.join(1)
+    assert results == ['before']
+    assert flight.do('positions', fetch) == 'after'
+    assert flight.stats['executed'] == 2
@@ -0,0 +1,33 @@
+import time
+
+from stream import Publisher, Refresher
+
+
+def test_wake_refreshes_changed_snapshots_between_full_refreshes():
+    calls = []
+    refresher = Refresher(Publisher(), calls.append, interval=0.3, linger=10)
+    refresher.touch()
+    refresher.start()
+    try:
+        time.sleep(0.05)
+        refresher.wake()
+        time.sleep(0.05)
+        refresher.wake()
+        time.sleep(0.05)
+        assert calls == [False, False]
+        time.sleep(0.3)
+        assert calls == [False, False, True]
+    finally:
+        refresher.stop()
+
+
+def test_idle_refresher_does_not_refresh():
+    calls = []
+    refresher = Refresher(Publisher(), calls.append, interval=0.05, linger=10)
+    refresher.start()
+    try:
+        refresher.wake()
+        time.sleep(0.2)
+        assert calls == []
+    finally:
+        refresher.stop()
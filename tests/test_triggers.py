@@ -0,0 +1,75 @@
+import threading
+import time
+import types
+
+from cache import SnapshotCache
+from fanout import FanOut
+from ticks import TickCache, update_from_positions
+from triggers import TriggerEngine
+
+
+class FakeUser(object):
+    """
+    User whose positions are cached and feed the tick cache
+    like the users of the server
+    """
+    def __init__(self, client_id, ticks):
+        self.broker = types.SimpleNamespace(client_id=client_id)
+        self.price = 100.0
+        self.exited = threading.Event()
+        self._positions = SnapshotCache(self._fetch, ttl=0)
+        self._positions.add_listener(lambda data: update_from_positions(ticks, data))
+
+    def _fetch(self):
+        return [{'symbol': 'NIFTY', 'exchange': 'NFO', 'quantity': 50, 'ltp': self.price}]
+
+    def positions(self):
+        return self._positions.get()
+
+    def exit_position_by_symbol(self, symbol, percent, product):
+        positions = self.positions()
+        self.exited.set()
+        return positions
+
+
+def test_stop_hit_by_price_of_positions_exits_without_waiting():
+    ticks = TickCache()
+    fanout = FanOut(max_workers=2, timeout=3)
+    user = FakeUser('C0', ticks)
+    engine = TriggerEngine([user], fanout)
+    ticks.add_listener(engine.on_tick)
+    user.positions()
+    engine.add('NIFTY', 95, kind='stop')
+    user.price = 90.0
+    start = time.monotonic()
+    user.positions()
+    elapsed = time.monotonic() - start
+    assert user.exited.wait(1)
+    assert elapsed < 1
+    for _ in range(100):
+        if engine.stats['fired']:
+            break
+        time.sleep(0.01)
+    fired = engine.stats['fired']
+    assert len(fired) == 1
+    assert fired[0]['price'] == 90.0
+    assert fired[0]['errors'] == {}
+    fanout.shutdown()
+
+
+def test_listeners_called_after_the_lock_is_released():
+    seen, blocked = [], []
+    cache = SnapshotCache(lambda: [len(seen)], ttl=0)
+    def listener(data):
+        seen.append(data)
+        if len(seen) > 1:
+            return
+        # Another thread reading the same cache must not wait on this call
+        thread = threading.Thread(target=cache.get)
+        thread.start()
+        thread.join(1)
+        blocked.append(thread.is_alive())
+    cache.add_listener(listener)
+    cache.get()
+    assert blocked == [False]
+    assert seen == [[0], [1]]
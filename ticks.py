@@ -0,0 +1,199 @@
+"""
+Last traded prices of all symbols
+
+Prices are kept by instrument token from the contract master
+and replaced with an immutable tick on every update, so readers
+on the order path never take a lock. Feeds run in their own
+threads and push prices into the cache
+"""
+import csv
+import json
+import threading
+import time
+from collections import namedtuple
+from typing import Callable, Dict, List, Optional
+
+import requests
+
+# source is positions for prices taken from the positions
+Tick = namedtuple('Tick', ['price', 'timestamp', 'source'])
+
+
+class TickCache(object):
+    """
+    Last price of each instrument keyed by token
+    """
+    def __init__(self, tokens:Dict[str, int]=None):
+        """
+        tokens
+            instrument tokens keyed by EXCHANGE:SYMBOL;
+            symbols without a token are keyed by EXCHANGE:SYMBOL
+        """
+        self._tokens:Dict[str, int] = tokens or {}
+        self._symbols:Dict = {token: key.split(':', 1)[1] for key,token in self._tokens.items()}
+        self._ticks:Dict = {}
+        self._listeners:List[Callable] = []
+        self.updates:int = 0
+
+    def add_listener(self, listener:Callable):
+        """
+        Call listener(symbol, price) on every update
+        """
+        self._listeners.append(listener)
+
+    def token(self, symbol:str, exchange:str='NFO'):
+        key = f"{exchange}:{symbol}"
+        return self._tokens.get(key, key)
+
+    def symbol(self, token)->str:
+        if token in self._symbols:
+            return self._symbols[token]
+        return str(token).split(':', 1)[-1]
+
+    def __len__(self)->int:
+        return len(self._ticks)
+
+    def update(self, token, price:float, timestamp:float=None, source:str='feed'):
+        """
+        Update the price of an instrument
+        """
+        price = float(price)
+        self._ticks[token] = Tick(price, timestamp or time.time(), source)
+        self.updates += 1
+        if self._listeners:
+            symbol = self.symbol(token)
+            for listener in self._listeners:
+                try:
+                    listener(symbol, price)
+                except Exception as e:
+                    print(e)
+
+    def update_symbol(self, symbol:str, price:float, exchange:str='NFO', timestamp:float=None):
+        self.update(self.token(symbol, exchange), price, timestamp)
+
+    def get(self, token, max_age:float=None)->Optional[Tick]:
+        """
+        Last tick of the instrument; None if there is no tick
+        or the tick is older than max_age seconds
+        """
+        tick = self._ticks.get(token)
+        if tick is None:
+            return None
+        if max_age is not None and time.time() - tick.timestamp > max_age:
+            return None
+        return tick
+
+    def ltp(self, symbol:str, exchange:str='NFO', max_age:float=None)->Optional[float]:
+        """
+        Last price of the symbol; None if not known
+        """
+        tick = self.get(self.token(symbol, exchange), max_age)
+        return tick.price if tick else None
+
+    @property
+    def stats(self)->Dict:
+        return {'symbols': len(self._ticks), 'updates': self.updates}
+
+
+def update_from_positions(cache:TickCache, positions:List[Dict], max_age:float=5):
+    """
+    Update the prices from the ltp of the positions for the
+    symbols without a tick from a live feed in the last max_age seconds
+    """
+    for p in positions:
+        ltp = p.get('ltp')
+        if not ltp:
+            continue
+        token = cache.token(p.get('symbol'), p.get('exchange') or 'NFO')
+        tick = cache.get(token, max_age)
+        if tick is None or tick.source == 'positions':
+            cache.update(token, ltp, source='positions')
+
+
+class Feed(object):
+    """
+    Base class of a feed pushing prices into the cache from a thread
+    """
+    def __init__(self, cache:TickCache):
+        self._cache = cache
+        self._stop = threading.Event()
+        self._thread = None
+
+    def run(self):
+        raise NotImplementedError
+
+    def _run(self):
+        try:
+            self.run()
+        except Exception as e:
+            print(e)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=type(self).__name__, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+
+class StreamFeed(Feed):
+    """
+    Prices streamed over http as json lines like
+    {"token": 35001, "price": 16520.5} or
+    {"exchange": "NFO", "symbol": "NIFTY22JUNFUT", "price": 16520.5}
+    reconnects after reconnect seconds
+    """
+    def __init__(self, cache:TickCache, url:str, reconnect:float=5):
+        super().__init__(cache)
+        self._url:str = url
+        self._reconnect:float = reconnect
+
+    def run(self):
+        while not self._stop.is_set():
+            try:
+                with requests.get(self._url, stream=True, timeout=30) as response:
+                    for line in response.iter_lines(decode_unicode=True):
+                        if self._stop.is_set():
+                            return
+                        if not line:
+                            continue
+                        tick = json.loads(line)
+                        if 'token' in tick:
+                            self._cache.update(tick['token'], tick['price'], tick.get('timestamp'))
+                        else:
+                            self._cache.update_symbol(tick['symbol'], tick['price'],
+                                    tick.get('exchange', 'NFO'), tick.get('timestamp'))
+            except Exception as e:
+                print(e)
+            self._stop.wait(self._reconnect)
+
+
+class ReplayFeed(Feed):
+    """
+    Replay prices from a csv file with the columns
+    timestamp, symbol, price and optionally exchange
+    """
+    def __init__(self, cache:TickCache, filename:str, speed:float=None):
+        """
+        speed
+            replay at this multiple of the original pace;
+            as fast as possible if None
+        """
+        super().__init__(cache)
+        self._filename:str = filename
+        self._speed:float = speed
+
+    def run(self):
+        previous = None
+        with open(self._filename, newline='') as f:
+            for row in csv.DictReader(f):
+                if self._stop.is_set():
+                    return
+                timestamp = float(row['timestamp'])
+                if self._speed and previous is not None:
+                    time.sleep(max(0, (timestamp - previous)/self._speed))
+                previous = timestamp
+                self._cache.update_symbol(row['symbol'], row['price'],
+                        row.get('exchange') or 'NFO')
@@ -0,0 +1,183 @@
+"""
+Server side stop and target levels
+
+Levels are kept in a price sorted list per symbol and checked
+against every price received. When the price crosses a level
+the positions of the symbol are exited for all users at market,
+so moving a stop is an update in memory instead of a
+modification of the resting order of every user
+"""
+import bisect
+import itertools
+import threading
+import time
+from collections import namedtuple
+from typing import Any, Dict, List, Optional
+
+from fanout import FanOut
+from scheduler import EMERGENCY
+
+# direction is below for a level hit when the price falls to it
+# and above for a level hit when the price rises to it
+Trigger = namedtuple('Trigger', ['id', 'symbol', 'kind', 'level', 'direction',
+    'product', 'percent', 'created'])
+
+DIRECTIONS = ('below', 'above')
+
+
+class TriggerEngine(object):
+    """
+    Stop and target levels of all symbols
+    """
+    def __init__(self, users:List, fanout:FanOut, history:int=1000):
+        """
+        users
+            list of users whose positions are exited
+        fanout
+            fan out pool used to exit the positions
+        history
+            number of fired triggers to keep
+        """
+        self._users = users
+        self._fanout = fanout
+        self._history:int = history
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._triggers:Dict[int, Trigger] = {}
+        # sorted (level, id) by symbol and direction
+        self._levels:Dict[str, Dict[str, List]] = {}
+        self._last:Dict[str, float] = {}
+        self._fired:List[Dict[str, Any]] = []
+        self.ticks:int = 0
+
+    def last_price(self, symbol:str)->Optional[float]:
+        return self._last.get(symbol)
+
+    def _direction(self, symbol:str, level:float, direction:str=None)->str:
+        if direction is not None:
+            if direction not in DIRECTIONS:
+                raise ValueError(f"direction must be one of {DIRECTIONS}")
+            return direction
+        last = self._last.get(symbol)
+        if last is None:
+            raise ValueError(f"no price for {symbol} yet; direction is required")
+        return 'below' if level < last else 'above'
+
+    def _insert(self, trigger:Trigger):
+        levels = self._levels.setdefault(trigger.symbol, {d: [] for d in DIRECTIONS})
+        bisect.insort(levels[trigger.direction], (trigger.level, trigger.id))
+        self._triggers[trigger.id] = trigger
+
+    def _remove(self, trigger:Trigger):
+        levels = self._levels[trigger.symbol][trigger.direction]
+        i = bisect.bisect_left(levels, (trigger.level, trigger.id))
+        if i < len(levels) and levels[i] == (trigger.level, trigger.id):
+            del levels[i]
+        del self._triggers[trigger.id]
+
+    def add(self, symbol:str, level:float, kind:str='stop', direction:str=None,
+            product:str='MIS', percent:float=1.0)->Trigger:
+        """
+        Add a level
+        symbol
+            symbol to exit
+        level
+            price at which positions are exited
+        kind
+            stop or target; for information only
+        direction
+            below or above; derived from the last price if None
+        product
+            product of the positions to exit
+        percent
+            percentage of the positions to exit
+        """
+        level = float(level)
+        with self._lock:
+            direction = self._direction(symbol, level, direction)
+            trigger = Trigger(next(self._ids), symbol, kind, level, direction,
+                    product, float(percent), time.time())
+            self._insert(trigger)
+        return trigger
+
+    def move(self, trigger_id:int, level:float, direction:str=None)->Trigger:
+        """
+        Move a level to a new price
+        """
+        level = float(level)
+        with self._lock:
+            trigger = self._triggers[trigger_id]
+            direction = self._direction(trigger.symbol, level, direction or trigger.direction)
+            self._remove(trigger)
+            trigger = trigger._replace(level=level, direction=direction)
+            self._insert(trigger)
+        return trigger
+
+    def cancel(self, trigger_id:int)->Trigger:
+        with self._lock:
+            trigger = self._triggers[trigger_id]
+            self._remove(trigger)
+        return trigger
+
+    def on_tick(self, symbol:str, price:float)->List[Trigger]:
+        """
+        Update the last price of the symbol and exit the
+        positions for the levels crossed by the price;
+        exits are submitted to the fan out pool and not waited
+        for since ticks may come from a snapshot being fetched
+        returns the triggers fired
+        """
+        price = float(price)
+        with self._lock:
+            self.ticks += 1
+            self._last[symbol] = price
+            levels = self._levels.get(symbol)
+            if not levels:
+                return []
+            below, above = levels['below'], levels['above']
+            # levels at or above the price for a falling price
+            i = bisect.bisect_left(below, (price,))
+            j = bisect.bisect_right(above, (price, float('inf')))
+            crossed = below[i:] + above[:j]
+            del below[i:]
+            del above[:j]
+            fired = [self._triggers.pop(trigger_id) for _, trigger_id in crossed]
+        for trigger in fired:
+            self._fire(trigger, price)
+        return fired
+
+    def _fire(self, trigger:Trigger, price:float):
+        print(f"{trigger.symbol}|{trigger.kind} {trigger.direction} {trigger.level} hit at {price}")
+        users = list(self._users)
+        fired = dict(trigger._asdict(), price=price, timestamp=time.time(),
+                users=len(users), errors={})
+        with self._lock:
+            self._fired.append(fired)
+            del self._fired[:-self._history]
+        def _exit(user):
+            try:
+                return user.exit_position_by_symbol(trigger.symbol, trigger.percent, trigger.product)
+            except Exception as e:
+                client_id = user.broker.client_id
+                print(client_id, e)
+                with self._lock:
+                    fired['errors'][client_id] = str(e)
+                raise
+        for user in users:
+            self._fanout.submit(_exit, user, priority=EMERGENCY)
+
+    def triggers(self, symbol:str=None)->List[Dict[str, Any]]:
+        with self._lock:
+            return [t._asdict() for t in sorted(self._triggers.values(), key=lambda t: (t.symbol, t.level))
+                    if symbol is None or t.symbol == symbol]
+
+    @property
+    def stats(self)->Dict[str, Any]:
+        with self._lock:
+            return {
+                    'triggers': len(self._triggers),
+                    'symbols': len(self._levels),
+                    'ticks': self.ticks,
+                    'fired': [dict(f, errors=dict(f['errors'])) for f in self._fired]
+                    }
+
@@ -1,5 +1,19 @@
 from fastbt.brokers.master_trust import MasterTrust 
-from typing import Tuple, List, Dict
+from typing import Tuple, List, Dict, Callable, Optional
+from types import MappingProxyType
+from cache import SnapshotCache, SnapshotIndex
+from records import Position, Order, to_records
+from contracts import ContractStore
+from sessions import PooledSession, install
+from journal import order_ids
+from scheduler import EMERGENCY
+from settings import CACHE_TTL, DEFAULT_LOT_SIZE, AUTH_WORKERS, AUTH_TIMEOUT
+from settings import POOL_SIZE, EXIT_LEGS_PER_ACCOUNT
+import concurrent.futures
+import datetime
+import os
+import threading
+import time
 import pandas as pd
 
 exchange_list = {
@@ -8,12 +22,20 @@ exchange_list = {
         3: ['NSE', 'NFO']
         }
 
+# Order arguments shared by the orders placed for positions
+MARKET_ORDER = MappingProxyType({'order_type': 'MARKET', 'validity': 'DAY'})
+SL_ORDER = MappingProxyType({'order_type': 'SL', 'validity': 'DAY'})
+LIMIT_ORDER = MappingProxyType({'order_type': 'LIMIT', 'validity': 'DAY'})
+
+# Send the broker requests through the session of each user
+install(MasterTrust)
+
 
 class User(object):
     """
     A simple user class
     """
-    def __init__(self, client_id:str, password:str, pin:str, secret:str, capital:float=1.0, max_loss:float=1e10, trail_after:float=1e3, trail_percent:float=1e3, target:float=1e10, exc_code:int=1):
+    def __init__(self, client_id:str, password:str, pin:str, secret:str, capital:float=1.0, max_loss:float=1e10, trail_after:float=1e3, trail_percent:float=1e3, target:float=1e10, exc_code:int=1, cache_ttl:float=CACHE_TTL, pool_size:int=POOL_SIZE, journal=None):
         """
         Initialize the user
         """
@@ -25,10 +47,29 @@ class User(object):
         self._target:float = abs(target)
         self._trail_after:float = trail_after
         self._trail_percent:float = trail_percent
-        self._broker.authenticate()
+        self._session = PooledSession(pool_size=pool_size, account=client_id)
+        # Rate limiter of broker requests; set by the server
+        self.limiter = None
+        # Journal of broker requests
+        self.journal = journal
+        self.authenticate()
         self._is_trailing:bool = False
         self._mtm:float= 0
         self._max_mtm:float = 0
+        # Broker responses are converted into records once per fetch
+        self._positions = SnapshotCache(
+                lambda: to_records(Position, self.call(self._broker.positions)), ttl=cache_ttl)
+        self._pending = SnapshotCache(
+                lambda: to_records(Order, self.call(self._broker.pending_orders)), ttl=cache_ttl)
+        self._position_index = SnapshotIndex(('symbol', 'product'))
+        self._pending_indexes = [
+                SnapshotIndex(('symbol', 'side', 'status')),
+                SnapshotIndex(('product', 'status'))
+                ]
+        # Replaced by the contract store shared by all users
+        self.contracts = ContractStore(default_lot_size=DEFAULT_LOT_SIZE)
+        # Last prices shared by all users; set by the server
+        self.ticks = None
         print(client_id)
 
     @property
@@ -67,34 +108,197 @@ class User(object):
     def allowed_segments(self)->List[str]:
         return self._allowed_segments
 
+    @property
+    def limiter(self):
+        return self._session.limiter
+
+    @limiter.setter
+    def limiter(self, limiter):
+        self._session.limiter = limiter
+
+    def authenticate(self):
+        """
+        Authenticate with the saved token if it was saved today
+        else login again since tokens expire every day
+        """
+        token_file = self._broker.token_file
+        try:
+            modified = datetime.date.fromtimestamp(os.path.getmtime(token_file))
+            is_valid = modified == datetime.date.today()
+        except OSError:
+            is_valid = False
+        self.call(self._broker.authenticate, force=not(is_valid))
+
+    def call(self, func:Callable, *args, **kwargs):
+        """
+        Call a broker function with the requests
+        sent through the session of the user;
+        each request waits for the rate limit.
+        The call is written to the journal
+        """
+        start = time.monotonic()
+        response, error = None, None
+        try:
+            with self._session.activate():
+                response = func(*args, **kwargs)
+            return response
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            if self.journal:
+                symbol = kwargs.get('symbol')
+                if symbol is None and args and isinstance(args[0], str):
+                    symbol = args[0]
+                self.journal.write('broker', client_id=self._broker.client_id,
+                        method=func.__name__, symbol=symbol,
+                        order_ids=order_ids(kwargs, response), args=args, kwargs=kwargs,
+                        response=response, error=str(error) if error else None,
+                        elapsed=time.monotonic()-start)
+
+    def warm(self):
+        """
+        Open or keep alive a connection to the broker
+        """
+        self._session.warm(self._broker.base_url)
+
+    @property
+    def session_stats(self)->Dict:
+        """
+        Connection reuse and connect vs server time of broker calls
+        """
+        return self._session.stats
+
+    def positions(self)->List[Dict]:
+        """
+        Get the positions from the snapshot cache
+        """
+        return self._positions.get()
+
+    def pending_orders(self)->List[Dict]:
+        """
+        Get the pending orders from the snapshot cache
+        """
+        return self._pending.get()
+
+    def ltp(self, symbol:str, exchange:str='NFO')->Optional[float]:
+        """
+        Last price of the symbol from the tick cache
+        """
+        if self.ticks is not None:
+            return self.ticks.ltp(symbol, exchange)
+
+    def positions_by_symbol(self, symbol:str, product:str)->List[Dict]:
+        """
+        Positions of the symbol and product
+        """
+        return self._position_index.get(self.positions(), symbol, product)
+
+    def pending_matching(self, **conditions)->List[Dict]:
+        """
+        Pending orders matching all the conditions like broker.filter
+        """
+        orders = self.pending_orders()
+        for index in self._pending_indexes:
+            if index.covers(conditions):
+                return index.select(orders, conditions)
+        return self._pending_indexes[0].select(orders, conditions)
+
+    def add_listener(self, listener:Callable):
+        """
+        Call listener(user, name, data) whenever fresh positions
+        or pending orders are fetched; name is positions or pending
+        """
+        self._positions.add_listener(lambda data: listener(self, 'positions', data))
+        self._pending.add_listener(lambda data: listener(self, 'pending', data))
+
+    def invalidate(self):
+        """
+        Invalidate the cached positions and pending orders
+        """
+        self._positions.invalidate()
+        self._pending.invalidate()
+
+    @property
+    def pending_changed(self)->bool:
+        """
+        Check whether the pending orders were invalidated
+        by an order sent and not fetched since
+        """
+        return self._pending.is_empty
+
+    @property
+    def cache_stats(self)->Dict[str, Dict]:
+        return {
+                'positions': self._positions.stats,
+                'pending': self._pending.stats
+                }
+
+    def send(self, method:str, *args, **kwargs):
+        """
+        Send a request that changes orders or positions
+        to the broker and invalidate the cached snapshots
+        method
+            name of the broker method to call
+        """
+        try:
+            return self.call(getattr(self.broker, method), *args, **kwargs)
+        finally:
+            self.invalidate()
+
+    def order_place(self, **kwargs):
+        """
+        Place an order
+        """
+        return self.send('order_place', **kwargs)
+
     def quantity(self, qty:int=1)->int:
         """
         Get the quantity for the user based on capital
         """
         return int(self.capital*int(qty))
 
-    def exit_all_bracket_orders(self):
-        """
-        Exit all bracket orders
-        """
-        broker = self.broker
-        orders = broker.pending_orders()
-        orders2 = broker.filter(orders, product='BO')
-        if len(orders) > 0:
-            orders = broker.filter(orders,product='BO', status='open')
-            for order in orders:
-                try:
-                    oms_order_id = order['oms_order_id']
-                    leg_order_indicator = order['leg_order_indicator']
-                    kwargs = {
-                            'oms_order_id': oms_order_id,
-                            'leg_order_indicator': leg_order_indicator,
-                            'status': 'open',
-                            'client_id': self.broker.client_id
-                            }
-                    broker.exit_bracket_order(**kwargs)
-                except Exception as e:
-                    print(e)
+    def _outcome(self, leg:Dict, func:Callable)->Dict:
+        """
+        Call func(leg) and return the outcome of the leg
+        with the response or error and the time taken
+        """
+        client_id = self.broker.client_id
+        outcome = dict(leg, client_id=client_id)
+        start = time.monotonic()
+        try:
+            outcome['response'] = func(leg)
+        except Exception as e:
+            print(client_id, e)
+            outcome['error'] = str(e)
+        outcome['elapsed'] = time.monotonic() - start
+        return outcome
+
+    def bracket_exits(self)->List[Dict]:
+        """
+        Legs to exit all open bracket orders; the pending
+        orders are fetched now since a cached snapshot
+        may miss orders filled or placed since
+        """
+        self._pending.invalidate()
+        return [{
+            'symbol': order.get('symbol'),
+            'oms_order_id': order.get('oms_order_id'),
+            'leg_order_indicator': order.get('leg_order_indicator')
+            } for order in self.pending_matching(product='BO', status='open')]
+
+    def exit_bracket_leg(self, leg:Dict)->Dict:
+        """
+        Exit a bracket order leg from bracket_exits
+        returns the outcome of the leg
+        """
+        def _exit(leg):
+            return self.send('exit_bracket_order',
+                    oms_order_id=leg['oms_order_id'],
+                    leg_order_indicator=leg['leg_order_indicator'],
+                    status='open',
+                    client_id=self.broker.client_id)
+        return self._outcome(leg, _exit)
 
     def exit_position_by_symbol(self, symbol:str, percent:float=1.0, product='MIS'):
         """
@@ -104,8 +308,7 @@ class User(object):
         percentage
             percentage of orders to exit
         """
-        positions = self.broker.positions()
-        positions = self.broker.filter(positions, symbol=symbol, product=product)
+        positions = self.positions_by_symbol(symbol, product)
         if len(positions) == 0:
             print(f"No positions for the given {symbol}")
             return
@@ -119,18 +322,15 @@ class User(object):
         side = 'BUY' if quantity <0 else 'SELL'
         exchange=positions.get('exchange')
         order_quantity = abs(int(quantity * percent))
-        if exchange == 'NFO':
-            order_quantity = int(order_quantity/50)*50
-        order_args = dict(
+        order_quantity = self.contracts.round_quantity(order_quantity, symbol, exchange)
+        order_args = dict(MARKET_ORDER,
                 symbol=symbol,
                 quantity=order_quantity,
                 side = side,
-                order_type='MARKET',
                 exchange=exchange,
-                product=product,
-                validity='DAY'
+                product=product
                 )
-        status = self.broker.order_place(**order_args)
+        status = self.order_place(**order_args)
         return status
 
     
@@ -142,9 +342,9 @@ class User(object):
         opposite
            reverse symbol to exit
         """
-        positions = self.broker.positions()
-        mis_pos   = self.broker.filter(positions, symbol=symbol, product='MIS')
-        nrml_pos  = self.broker.filter(positions, symbol=symbol, product='NRML')
+        statuses = []
+        mis_pos   = self.positions_by_symbol(symbol, 'MIS')
+        nrml_pos  = self.positions_by_symbol(symbol, 'NRML')
 
         if len(mis_pos) == 0:
             print(f"No MIS positions for the given {symbol}")
@@ -168,38 +368,38 @@ class User(object):
         side = 'BUY' if quantity <0 else 'SELL'
         exchange=positions.get('exchange')
         product=positions.get('product')
-        order_args = dict(
+        order_args = dict(MARKET_ORDER,
                 symbol=symbol,
-                quantity=quantity,
+                quantity=abs(quantity),
                 side = side,
-                order_type='MARKET',
                 exchange=exchange,
-                product=product,
-                validity='DAY'
+                product=product
                 )
-        close_stat = self.broker.order_place(**order_args)
+        close_stat = self.order_place(**order_args)
         statuses.append(close_stat)
         order_quantity = abs(int(quantity * percent))
         exchange=positions.get('exchange')
-        if exchange == 'NFO':
-            order_quantity = int(order_quantity/50)*50
+        order_quantity = self.contracts.round_quantity(order_quantity, opposite, exchange)
         order_args['side']='BUY'
         order_args['symbol']=opposite
         order_args['product']='MIS'
         order_args['quantity']=order_quantity
-        new_stat = self.broker.order_place(**order_args)
+        new_stat = self.order_place(**order_args)
         statuses.append(new_stat)
         return statuses
 
-    def exit_all_positions(self):
+    def position_exits(self)->List[Dict]:
         """
-        exit all positions
+        Market orders to exit all positions; the positions
+        are fetched now since exiting a position already
+        closed by a stop would open a reverse position
         """
-        positions = self.broker.positions()
-        statuses = []
+        self._positions.invalidate()
+        positions = self.positions()
+        legs = []
         if len(positions) == 0:
             print(f"No positions exist")
-            return
+            return legs
         for position in positions:
             symbol = position.get('symbol')
             quantity = position.get('quantity', 0)
@@ -209,19 +409,23 @@ class User(object):
                 print(f"Nothing to exit for {symbol} since positions are zero")
             else:
                 side = 'BUY' if quantity <0 else 'SELL'
-                order_args = dict(
+                order_args = dict(MARKET_ORDER,
                         symbol=symbol,
-                        quantity=quantity,
+                        quantity=abs(quantity),
                         side = side,
-                        order_type='MARKET',
                         exchange=exchange,
-                        product=product,
-                        validity='DAY'
+                        product=product
                         )
-                status = self.broker.order_place(**order_args)
-                statuses.append(status)
-        return statuses
-    
+                legs.append(order_args)
+        return legs
+
+    def exit_position_leg(self, order_args:Dict)->Dict:
+        """
+        Place an order from position_exits
+        returns the outcome of the order
+        """
+        return self._outcome(order_args, lambda order_args: self.order_place(**order_args))
+
     def stop_for_position_by_symbol(self, symbol:str, trigger_price:float, percent:float=1.0, product='MIS'):
         """
         stop for positions by symbol
@@ -232,8 +436,7 @@ class User(object):
         product
             MIS or NRML
         """
-        positions = self.broker.positions()
-        positions = self.broker.filter(positions, symbol=symbol, product=product)
+        positions = self.positions_by_symbol(symbol, product)
         if len(positions) == 0:
             print(f"No positions for the given {symbol}")
             return
@@ -247,24 +450,28 @@ class User(object):
             return
         side = 'BUY' if quantity <0 else 'SELL'
         delta = 1 if side=='BUY' else -1
-        price = int(float(trigger_price) + (delta * 2/100 * float(trigger_price)))        
         order_quantity = abs(int(quantity * percent))
         
         exchange=positions.get('exchange')
-        if exchange == 'NFO':
-            order_quantity = int(order_quantity/50)*50
-        order_args = dict(
+        # A stop already crossed by the price would be filled at once
+        ltp = self.ltp(symbol, exchange) or positions.get('ltp')
+        if ltp and ((side == 'SELL' and float(trigger_price) >= ltp) or
+                (side == 'BUY' and float(trigger_price) <= ltp)):
+            print(f"Stop {trigger_price} for {symbol} already crossed by the last price {ltp}")
+            return {'message': f"trigger price {trigger_price} already crossed by last price {ltp}"}
+        price = float(trigger_price) + (delta * 2/100 * float(trigger_price))
+        price = self.contracts.round_price(price, symbol, exchange)
+        order_quantity = self.contracts.round_quantity(order_quantity, symbol, exchange)
+        order_args = dict(SL_ORDER,
                 symbol=symbol,
                 quantity=order_quantity,
                 price=price,
                 side = side,
                 trigger_price= trigger_price,
-                order_type='SL',
                 exchange=exchange,
-                product=product,
-                validity='DAY'
+                product=product
                 )
-        status = self.broker.order_place(**order_args)
+        status = self.order_place(**order_args)
         return status
 
     def target_for_position_by_symbol(self, symbol:str, price:float, percent:float=1.0, product='NRML'):
@@ -277,8 +484,7 @@ class User(object):
         product
             MIS or NRML
         """
-        positions = self.broker.positions()
-        positions = self.broker.filter(positions, symbol=symbol, product=product)
+        positions = self.positions_by_symbol(symbol, product)
         if len(positions) == 0:
             print(f"No positions for the given {symbol}")
             return
@@ -295,19 +501,17 @@ class User(object):
         order_quantity = abs(int(quantity * percent))
         
         exchange=positions.get('exchange')
-        if exchange == 'NFO':
-            order_quantity = int(order_quantity/50)*50
-        order_args = dict(
+        price = self.contracts.round_price(price, symbol, exchange)
+        order_quantity = self.contracts.round_quantity(order_quantity, symbol, exchange)
+        order_args = dict(LIMIT_ORDER,
                 symbol=symbol,
                 quantity=order_quantity,
                 price=price,
-                side = side,                
-                order_type='LIMIT',
+                side = side,
                 exchange=exchange,
-                product=product,
-                validity='DAY'
+                product=product
                 )
-        status = self.broker.order_place(**order_args)
+        status = self.order_place(**order_args)
         return status
 
     @property
@@ -352,20 +556,191 @@ class User(object):
             return False
 
 
-def load_all_users(filename:str='../confid/users_all.xls') -> List[User]:
+# Authentication status and latency of each user by client_id
+AUTH_STATUS:Dict[str, Dict] = {}
+# Monotonic time at which the authentication of each user started
+_AUTH_STARTED:Dict[str, float] = {}
+_AUTH_LOCK = threading.Lock()
+
+def exit_lanes(pairs:List[Tuple[User, Dict]], per_account:int=EXIT_LEGS_PER_ACCOUNT)->List[Tuple[User, List[Dict]]]:
+    """
+    Split the legs of each user into lanes whose legs are
+    sent one after another so that at most per_account
+    legs of an account are sent at the same time
+    pairs
+        list of (user, leg)
+    per_account
+        maximum number of lanes of a user
+    returns a list of (user, legs) with one item per lane
+    """
+    legs_of:Dict[User, List[Dict]] = {}
+    for user, leg in pairs:
+        legs_of.setdefault(user, []).append(leg)
+    per_account = max(1, per_account)
+    return [(user, legs[i::per_account]) for user, legs in legs_of.items()
+            for i in range(min(per_account, len(legs)))]
+
+def exit_users(fanout, users:List[User], priority:int=EMERGENCY, brackets:bool=False,
+        per_account:int=EXIT_LEGS_PER_ACCOUNT)->List[Dict]:
+    """
+    Exit all positions of the users; the legs of all
+    users are sent together on the fan out pool
+    with at most per_account legs of a user at a time
+    fanout
+        fan out pool
+    users
+        list of users
+    priority
+        priority class of the calls
+    brackets
+        exit the bracket orders and cancel the pending
+        orders of the users before exiting the positions
+    per_account
+        maximum number of legs of a user sent at the same time
+    returns the outcome of each leg
+    """
+    def _legs(get_legs):
+        pairs = []
+        for result in fanout.map(get_legs, users, priority=priority):
+            if result.error:
+                print(result.item.broker.client_id, result.error)
+            elif result.value:
+                pairs.extend((result.item, leg) for leg in result.value)
+        return pairs
+    def _send(pairs, exit_leg):
+        outcomes = []
+        lanes = exit_lanes(pairs, per_account)
+        for result in fanout.map(lambda lane: [exit_leg(lane[0], leg) for leg in lane[1]],
+                lanes, priority=priority):
+            if result.error:
+                user, legs = result.item
+                outcomes.extend(dict(leg, client_id=user.broker.client_id,
+                    error=str(result.error)) for leg in legs)
+            else:
+                outcomes.extend(result.value)
+        return outcomes
+    def _cancel(user):
+        # Pending orders were fetched by bracket_exits
+        if user.pending_orders():
+            return user.send('cancel_all_orders_by_conditions')
+    outcomes = []
+    if brackets:
+        outcomes.extend(_send(_legs(User.bracket_exits), User.exit_bracket_leg))
+        for result in fanout.map(_cancel, users, priority=priority):
+            if result.error:
+                print(result.item.broker.client_id, result.error)
+    outcomes.extend(_send(_legs(User.position_exits), User.exit_position_leg))
+    return outcomes
+
+def _create_user(kwargs:Dict, journal=None)->User:
+    client_id = kwargs.get('client_id')
+    start = time.monotonic()
+    with _AUTH_LOCK:
+        AUTH_STATUS[client_id] = {'status': 'pending'}
+        _AUTH_STARTED[client_id] = start
+    try:
+        user = User(**kwargs, journal=journal)
+    except Exception as e:
+        with _AUTH_LOCK:
+            if AUTH_STATUS[client_id]['status'] == 'pending':
+                AUTH_STATUS[client_id] = {'status': 'failed',
+                        'latency': time.monotonic()-start, 'error': str(e)}
+        raise
+    with _AUTH_LOCK:
+        # Users which timed out stay failed
+        if AUTH_STATUS[client_id]['status'] != 'pending':
+            raise TimeoutError(f"{client_id} authenticated after the timeout; left failed")
+        AUTH_STATUS[client_id] = {'status': 'ok', 'latency': time.monotonic()-start}
+    return user
+
+def _expire(client_id:str, timeout:float)->bool:
+    """
+    Mark the user as failed if the authentication
+    started more than timeout seconds ago
+    returns True if the user is failed
+    """
+    with _AUTH_LOCK:
+        status = AUTH_STATUS.get(client_id, {}).get('status')
+        if status == 'failed':
+            return True
+        started = _AUTH_STARTED.get(client_id)
+        if status != 'pending' or started is None:
+            return False
+        elapsed = time.monotonic() - started
+        if elapsed < timeout:
+            return False
+        AUTH_STATUS[client_id] = {'status': 'failed', 'latency': elapsed,
+                'error': f'timed out after {timeout}s'}
+    print(client_id, AUTH_STATUS[client_id])
+    return True
+
+def _expire_all(pending:Dict[concurrent.futures.Future, str], timeout:float):
+    """
+    Mark the users still authenticating as failed once
+    timeout seconds have passed since each of them started
+    pending
+        client_id of the user by future
+    """
+    pending = dict(pending)
+    while pending:
+        starts = [_AUTH_STARTED[client_id] for client_id in pending.values()
+                if client_id in _AUTH_STARTED]
+        wait = min(starts) + timeout - time.monotonic() if starts else timeout
+        done, not_done = concurrent.futures.wait(pending, timeout=max(0.01, wait),
+                return_when=concurrent.futures.FIRST_COMPLETED)
+        pending = {future: client_id for future, client_id in pending.items()
+                if future in not_done and not _expire(client_id, timeout)}
+
+def load_all_users(filename:str='../confid/users_all.xls', max_workers:int=AUTH_WORKERS,
+        timeout:float=AUTH_TIMEOUT, on_ready:Callable=None, journal=None) -> List[User]:
     """
     Load all users in the file with broker enabled
+    Users are authenticated concurrently
     filename
         Excel file in required xls format with one row per user
+    max_workers
+        maximum number of users authenticated at the same time
+    timeout
+        seconds to wait for each user to be authenticated;
+        users not authenticated by then are marked failed
+    on_ready
+        function called with each user authenticated after the
+        first timeout while waiting for a free worker;
+        such users are not returned
+    journal
+        journal of the broker requests of the users
+        including authentication
+    returns the users authenticated within the first timeout
     """
     xls = pd.read_excel(filename).to_dict(orient='records')
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers,
+            thread_name_prefix='auth')
+    futures = {executor.submit(_create_user, kwargs, journal): kwargs.get('client_id')
+            for kwargs in xls}
+    executor.shutdown(wait=False)
+    done, not_done = concurrent.futures.wait(futures, timeout=timeout)
     users = []
-    for kwargs in xls:
+    for future in futures:
+        if future in done:
+            try:
+                users.append(future.result())
+            except Exception as e:
+                print(e)
+    def _on_ready(future):
         try:
-            u = User(**kwargs)
-            users.append(u)
+            user = future.result()
+            print(f"{user.broker.client_id} authenticated after the timeout")
+            if on_ready:
+                on_ready(user)
         except Exception as e:
             print(e)
+    for future in not_done:
+        future.add_done_callback(_on_ready)
+    if not_done:
+        threading.Thread(target=_expire_all, name='auth-timeout', daemon=True,
+                args=({future: futures[future] for future in not_done}, timeout)).start()
+    for client_id, status in AUTH_STATUS.items():
+        print(client_id, status)
     return users
 
 def load_shortcuts(filename:str='shortcuts.csv') -> Dict[str,str]: